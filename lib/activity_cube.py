@@ -0,0 +1,293 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pathlib import Path
+
+import mad_store
+import calendar_dim
+
+
+ROOT_dir = Path(__file__).parent.parent
+cube_folder = os.path.join(ROOT_dir, 'dbs/devices/activity')
+
+
+def bit_count(words):
+    """
+    :param words: unsigned integer array, (n,) or (n, k)
+    :return: int64 array, number of set bits per row
+    """
+    words = np.ascontiguousarray(words)
+    if hasattr(np, 'bitwise_count'):    # numpy >= 2.0
+        counts = np.bitwise_count(words).astype(np.int64)
+        return counts.sum(axis=1) if counts.ndim > 1 else counts
+    return np.unpackbits(words.view(np.uint8).reshape(len(words), -1), axis=1).sum(axis=1).astype(np.int64)
+
+
+class ActivityCube:
+    def __init__(self, name='stops', folder=cube_folder, num_shards=64, compact_every=16):
+        """
+        Persistent per-device activity: a 24-bit active-hour bitmap per active device-day and a dense
+        active-day bitmap per device over the days of the calendar (calendar_dim.start_date - end_date).
+        Devices are keyed by the device_id of device_dict.DeviceDictionary and sharded the same way
+        (shard = device_id % num_shards, row = device_id // num_shards); shard s is stored as
+        folder/name/shard_{s}.parquet with one row (device_id, day, hours) per active device-day.
+        Updates are a bitwise OR, so records can be added day by day and adding them twice changes nothing.
+        Each save writes the updates as one delta file (folder/name/_delta/), which queries merge on read;
+        every compact_every saves the deltas are merged into the shard files, which rewrites the whole cube.
+        :param name: str, cube name, e.g., 'raw' for the raw records or 'stops' for the stops
+        :param folder: folder of the cubes
+        :param num_shards: int, number of shards (that of the device dictionary)
+        :param compact_every: int, number of delta files that triggers a compaction on save
+        """
+        self.folder = os.path.join(folder, name)
+        self.num_shards = num_shards
+        self.compact_every = compact_every
+        self.first_day = np.datetime64(calendar_dim.start_date, 'D').astype(np.int64)
+        self.num_days = int(np.datetime64(calendar_dim.end_date, 'D').astype(np.int64) - self.first_day + 1)
+        self.num_words = (self.num_days + 63) // 64
+        self.rows = dict()      # shard -> (row, day, hours) arrays sorted by row and day, loaded shards only
+        self.days = dict()      # shard -> (rows, num_words) uint64 array, bit d of a row = active on day d
+        self.pending = dict()   # shard -> (row, day, hours) of the updates not saved yet
+
+    def shard_file(self, shard=None):
+        return os.path.join(self.folder, f'shard_{shard}.parquet')
+
+    @staticmethod
+    def empty():
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([], dtype=np.uint32)
+
+    def delta_folder(self):
+        return os.path.join(self.folder, '_delta')
+
+    def delta_files(self):
+        if not os.path.isdir(self.delta_folder()):
+            return []
+        return sorted(os.path.join(self.delta_folder(), f) for f in os.listdir(self.delta_folder())
+                      if f.startswith('delta_') and f.endswith('.parquet'))
+
+    def read_shard(self, shard=None, delta_files=None):
+        """
+        :return: (row, day, hours) of a shard on disk, the shard file merged with the delta files
+        """
+        tables = []
+        if os.path.isfile(self.shard_file(shard)):
+            tables.append(pq.read_table(self.shard_file(shard), columns=['device_id', 'day', 'hours']))
+        for file_path in delta_files:
+            tables.append(pq.read_table(file_path, columns=['device_id', 'day', 'hours'],
+                                        filters=[('shard', '==', shard)]))
+        if not tables:
+            return self.empty()
+        table = pa.concat_tables(tables)
+        return self.merge(table.column('device_id').to_numpy().astype(np.int64) // self.num_shards,
+                          table.column('day').to_numpy().astype(np.int64),
+                          table.column('hours').to_numpy().astype(np.int32).view(np.uint32))
+
+    def shard_exists(self, shard=None, delta_files=None):
+        return os.path.isfile(self.shard_file(shard)) or shard in self.rows or shard in self.pending or \
+            bool(delta_files)
+
+    def load_shard(self, shard=None):
+        if shard not in self.rows:
+            row, day, hours = self.read_shard(shard, self.delta_files())
+            if shard in self.pending:
+                new_row, new_day, new_hours = self.pending[shard]
+                row, day, hours = self.merge(np.concatenate([row, new_row]), np.concatenate([day, new_day]),
+                                             np.concatenate([hours, new_hours]))
+            self.rows[shard] = (row, day, hours)
+        return self.rows[shard]
+
+    @staticmethod
+    def merge(row=None, day=None, hours=None):
+        """
+        One (row, day) entry with the OR of its hour bitmaps, sorted by row and day.
+        """
+        key = row * 65536 + day
+        order = np.argsort(key, kind='stable')
+        key, hours = key[order], hours[order]
+        if len(key) == 0:
+            return row, day, hours
+        starts = np.flatnonzero(np.r_[True, key[1:] != key[:-1]])
+        key, hours = key[starts], np.bitwise_or.reduceat(hours, starts)
+        return key // 65536, key % 65536, hours
+
+    def update(self, device_id=None, dates=None, hours=None):
+        """
+        Add activity records; records of unknown devices (negative ids) and days outside the calendar are skipped.
+        Only the updates are kept in memory until save; loaded shards are updated too.
+        :param device_id: array-like of device ids
+        :param dates: array-like of local dates
+        :param hours: array-like of local hours (0-23)
+        """
+        device_id = np.asarray(device_id, dtype=np.int64)
+        day = calendar_dim.day_index(dates).astype(np.int64)
+        hours = np.asarray(hours, dtype=np.int64)
+        keep = (device_id >= 0) & (day >= 0) & (hours >= 0) & (hours < 24)
+        device_id, day = device_id[keep], day[keep]
+        bits = np.left_shift(np.uint32(1), hours[keep].astype(np.uint32))
+        shards = device_id % self.num_shards
+        for shard in np.unique(shards):
+            mask = shards == shard
+            new = (device_id[mask] // self.num_shards, day[mask], bits[mask])
+            self.pending[shard] = self.merge(*(np.concatenate([a, b]) for a, b in
+                                               zip(self.pending.get(shard, self.empty()), new)))
+            if shard in self.rows:
+                self.rows[shard] = self.merge(*(np.concatenate([a, b]) for a, b in zip(self.rows[shard], new)))
+            self.days.pop(shard, None)
+
+    def save(self):
+        """
+        Write the updates since the last save as one delta file, under the lock of the cube, and compact the
+        cube when compact_every delta files have accumulated.
+        """
+        if not self.pending:
+            return
+        os.makedirs(self.delta_folder(), exist_ok=True)
+        with mad_store.file_lock(self.folder):
+            file_path = os.path.join(self.delta_folder(), f'delta_{time.time_ns()}_{os.getpid()}.parquet')
+            tmp_path = mad_store.temp_file(file_path)
+            schema = pa.schema([('shard', pa.int16()), ('device_id', pa.int64()), ('day', pa.int16()),
+                                ('hours', pa.int32())])
+            with pq.ParquetWriter(tmp_path, schema, compression='zstd') as writer:
+                for shard in sorted(self.pending):
+                    row, day, hours = self.pending[shard]
+                    writer.write_table(self.shard_table(shard, row, day, hours, schema=schema))
+            os.replace(tmp_path, file_path)
+            print(f'Activity cube saved ({len(self.pending)} shards updated).')
+            self.pending = dict()
+            if len(self.delta_files()) >= self.compact_every:
+                self.compact(locked=True)
+
+    def shard_table(self, shard=None, row=None, day=None, hours=None, schema=None):
+        columns = {'device_id': pa.array(row * self.num_shards + shard, type=pa.int64()),
+                   'day': pa.array(day, type=pa.int16()),
+                   'hours': pa.array(hours.view(np.int32), type=pa.int32())}
+        if schema is not None and 'shard' in schema.names:
+            columns = dict(shard=pa.array(np.full(len(row), shard), type=pa.int16()), **columns)
+        return pa.table(columns)
+
+    def compact(self, locked=False):
+        """
+        Merge the delta files into the shard files and remove them.
+        :param locked: boolean, if true, the caller holds the lock of the cube
+        """
+        if not locked:
+            with mad_store.file_lock(self.folder):
+                return self.compact(locked=True)
+        delta_files = self.delta_files()
+        if not delta_files:
+            return
+        for shard in range(self.num_shards):
+            if not self.shard_exists(shard, delta_files):
+                continue
+            row, day, hours = self.read_shard(shard, delta_files)
+            file_path = self.shard_file(shard)
+            tmp_path = mad_store.temp_file(file_path)
+            pq.write_table(self.shard_table(shard, row, day, hours), tmp_path, compression='zstd')
+            os.replace(tmp_path, file_path)
+        for file_path in delta_files:
+            os.remove(file_path)
+        print(f'Activity cube compacted ({len(delta_files)} delta files merged).')
+
+    def day_bitmap(self, shard=None):
+        if shard not in self.days:
+            row, day, _ = self.load_shard(shard)
+            n = int(row[-1]) + 1 if len(row) else 0
+            bits = np.zeros(n * self.num_words, dtype=np.uint64)
+            if n > 0:
+                # Rows are sorted by row and day, so the words are too
+                word = row * self.num_words + day // 64
+                starts = np.flatnonzero(np.r_[True, word[1:] != word[:-1]])
+                bits[word[starts]] = np.bitwise_or.reduceat(
+                    np.left_shift(np.uint64(1), (day % 64).astype(np.uint64)), starts)
+            self.days[shard] = bits.reshape(n, self.num_words)
+        return self.days[shard]
+
+    def day_range(self, start=None, end=None):
+        """
+        :param start: first date, None for the first day of the calendar
+        :param end: last date, None for the last day of the calendar
+        :return: first and last day index, clipped to the calendar
+        """
+        first = 0 if start is None else calendar_dim.epoch_days([start])[0] - self.first_day
+        last = self.num_days - 1 if end is None else calendar_dim.epoch_days([end])[0] - self.first_day
+        return int(max(first, 0)), int(min(last, self.num_days - 1))
+
+    def day_mask(self, start=None, end=None):
+        """
+        :return: (num_words,) uint64 array with the bits of the days in [start, end]
+        """
+        first, last = self.day_range(start, end)
+        days = np.zeros(self.num_words * 64, dtype=bool)
+        days[first:last + 1] = True
+        return np.packbits(days, bitorder='little').view('<u8').astype(np.uint64)
+
+    def period_days(self, periods=None):
+        """
+        Active days per device in each period, from the day bitmaps.
+        :param periods: dict of name -> (start, end), dates included; None for the whole calendar
+        :return: dataframe of device_id and one column of active days per period,
+        devices active in at least one of the periods
+        """
+        periods = periods or {'no_active_days': (None, None)}
+        masks = {name: self.day_mask(start, end) for name, (start, end) in periods.items()}
+        delta_files = self.delta_files()
+        out = []
+        for shard in range(self.num_shards):
+            if not self.shard_exists(shard, delta_files):
+                continue
+            bits = self.day_bitmap(shard)
+            counts = dict()
+            for name, mask in masks.items():
+                words = np.flatnonzero(mask)
+                counts[name] = bit_count(bits[:, words] & mask[words])
+            active = np.flatnonzero(np.logical_or.reduce([c > 0 for c in counts.values()]))
+            df = pd.DataFrame({name: c[active] for name, c in counts.items()})
+            df.insert(0, 'device_id', active * self.num_shards + shard)
+            out.append(df)
+        if not out:
+            return pd.DataFrame(columns=['device_id'] + list(periods))
+        return pd.concat(out, ignore_index=True)
+
+    def devices(self, min_days=1, start=None, end=None):
+        """
+        :return: int64 array of the ids of devices with at least min_days active days in [start, end]
+        """
+        df = self.period_days(periods={'days': (start, end)})
+        return df.loc[df['days'] >= min_days, 'device_id'].values.astype(np.int64)
+
+    def active_days(self, device_id=None, start=None, end=None):
+        """
+        :param device_id: array-like of device ids
+        :return: int64 array of the active days in [start, end] of each device (0 for unknown devices)
+        """
+        device_id = np.asarray(device_id, dtype=np.int64)
+        mask = self.day_mask(start, end)
+        words = np.flatnonzero(mask)
+        out = np.zeros(len(device_id), dtype=np.int64)
+        shards, row = device_id % self.num_shards, device_id // self.num_shards
+        for shard in np.unique(shards[device_id >= 0]):
+            bits = self.day_bitmap(shard)
+            sel = np.flatnonzero((shards == shard) & (device_id >= 0) & (row < len(bits)))
+            out[sel] = bit_count(bits[row[sel]][:, words] & mask[words])
+        return out
+
+    def active_hours(self, device_id=None, start=None, end=None):
+        """
+        :param device_id: array-like of device ids
+        :return: int64 array of the active hours (device-hours) in [start, end] of each device
+        """
+        device_id = np.asarray(device_id, dtype=np.int64)
+        first, last = self.day_range(start, end)
+        out = np.zeros(len(device_id), dtype=np.int64)
+        shards, row = device_id % self.num_shards, device_id // self.num_shards
+        for shard in np.unique(shards[device_id >= 0]):
+            rows, day, hours = self.load_shard(shard)
+            in_range = (day >= first) & (day <= last)
+            counts = np.bincount(rows[in_range], weights=bit_count(hours[in_range]),
+                                 minlength=int(rows[-1]) + 1 if len(rows) else 0).astype(np.int64)
+            sel = np.flatnonzero((shards == shard) & (device_id >= 0) & (row < len(counts)))
+            out[sel] = counts[row[sel]]
+        return out
@@ -0,0 +1,186 @@
+import os
+import yaml
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+
+ROOT_dir = Path(__file__).parent.parent
+holidays_file = os.path.join(ROOT_dir, 'dbs/holidays.yaml')
+start_date = '2019-01-01'
+end_date = '2023-12-31'
+day_columns = ['date', 'year', 'month', 'week', 'weekday', 'day_of_year']
+ns_per_day = 86400 * 10**9
+
+
+def day_fields(days):
+    """
+    Calendar attributes of days, computed with integer arithmetic
+    :param days: int64 array, days since 1970-01-01
+    :return: dict of arrays date (datetime64[D]), year, month, week (ISO), weekday (Monday=0), day_of_year
+    """
+    date = days.astype('datetime64[D]')
+    weekday = (days + 3) % 7    # 1970-01-01 was a Thursday
+    # The ISO week of a day is the week of the Thursday of the same week in the ISO year of that Thursday
+    thursday = (days - weekday + 3).astype('datetime64[D]')
+    iso_year = thursday.astype('datetime64[Y]')
+    year = date.astype('datetime64[Y]')
+    return dict(date=date,
+                year=year.astype(np.int64) + 1970,
+                month=date.astype('datetime64[M]').astype(np.int64) % 12 + 1,
+                week=(thursday - iso_year.astype('datetime64[D]')).astype(np.int64) // 7 + 1,
+                weekday=weekday,
+                day_of_year=(date - year.astype('datetime64[D]')).astype(np.int64) + 1)
+
+
+def load_holidays(file=holidays_file):
+    """
+    :param file: yaml of {state: {period: 'YYYYMMDD-YYYYMMDD,YYYYMMDD' or '-'}}
+    :return: dict of state -> list of (first day, last day) as datetime64[D]
+    """
+    with open(file, 'r') as f:
+        holidays = yaml.safe_load(f)
+    periods = dict()
+    for state, state_periods in holidays.items():
+        periods[state] = []
+        for period in state_periods.values():
+            if period == '-':
+                continue
+            for date_range in str(period).split(','):
+                first, _, last = date_range.strip().partition('-')
+                periods[state].append((np.datetime64(pd.Timestamp(first).date()),
+                                       np.datetime64(pd.Timestamp(last or first).date())))
+    return periods
+
+
+def build_calendar(start=start_date, end=end_date, holidays=holidays_file):
+    """
+    One row per local day with an int32 day index (days since start), calendar attributes
+    and one school-holiday flag per state (holiday_{state}).
+    :param start: first day
+    :param end: last day
+    :param holidays: yaml file of the state holidays, None to skip the flags
+    :return: dataframe
+    """
+    first = np.datetime64(pd.Timestamp(start).date())
+    days = np.arange(first, np.datetime64(pd.Timestamp(end).date()) + 1).astype(np.int64)
+    fields = day_fields(days)
+    calendar = pd.DataFrame(dict(day=np.arange(len(days), dtype=np.int32),
+                                 date=fields['date'],
+                                 year=fields['year'].astype(np.int16),
+                                 month=fields['month'].astype(np.int8),
+                                 week=fields['week'].astype(np.int8),
+                                 weekday=fields['weekday'].astype(np.int8),
+                                 day_of_year=fields['day_of_year'].astype(np.int16)))
+    if holidays is not None and os.path.isfile(holidays):
+        for state, periods in load_holidays(holidays).items():
+            flag = np.zeros(len(days), dtype=np.int8)
+            for p_first, p_last in periods:
+                flag[(calendar['date'].values >= p_first) & (calendar['date'].values <= p_last)] = 1
+            calendar[f'holiday_{state}'] = flag
+    return calendar
+
+
+_calendar = None
+
+
+def get_calendar():
+    """
+    Calendar of start_date - end_date, built once per process.
+    """
+    global _calendar
+    if _calendar is None:
+        _calendar = build_calendar()
+    return _calendar
+
+
+def epoch_days(dates):
+    """
+    :param dates: array-like of dates (datetime.date, strings, datetime64 or Timestamps)
+    :return: int64 array of days since 1970-01-01; each distinct value is parsed once
+    """
+    codes, uniques = pd.factorize(pd.Series(dates))
+    parsed = pd.to_datetime(pd.Series(uniques))
+    if isinstance(parsed.dtype, pd.DatetimeTZDtype):
+        parsed = parsed.dt.tz_localize(None)
+    days = parsed.values.astype('datetime64[D]').astype(np.int64)
+    return np.where(codes >= 0, days[codes], np.iinfo(np.int64).min)
+
+
+def day_index(dates):
+    """
+    :param dates: array-like of dates
+    :return: int32 day index of the calendar, -1 outside it
+    """
+    idx = epoch_days(dates) - np.datetime64(start_date, 'D').astype(np.int64)
+    return np.where((idx >= 0) & (idx < len(get_calendar())), idx, -1).astype(np.int32)
+
+
+def parse_dates(dates):
+    """
+    pd.to_datetime of a date column, parsing each distinct day once.
+    """
+    return epoch_days(dates).astype('datetime64[D]').astype('datetime64[ns]')
+
+
+def day_attributes(days, columns=day_columns):
+    """
+    Gather calendar attributes; days outside the calendar are computed with day_fields.
+    :param days: int64 array, days since 1970-01-01
+    :param columns: list of calendar columns
+    :return: dict of arrays
+    """
+    calendar = get_calendar()
+    idx = days - np.datetime64(start_date, 'D').astype(np.int64)
+    inside = (idx >= 0) & (idx < len(calendar))
+    gathered = np.where(inside, idx, 0)
+    out = {c: (calendar[c].values.astype('datetime64[D]') if c == 'date' else calendar[c].values)[gathered]
+           for c in columns}
+    if not inside.all():
+        fields = day_fields(days[~inside])
+        for c in columns:
+            out[c] = out[c].astype(np.int64) if c != 'date' else out[c]
+            out[c][~inside] = fields[c]
+    return out
+
+
+def wall_clock_ns(localtime):
+    """
+    :param localtime: series of local times (tz-aware, naive or objects with mixed time zones)
+    :return: int64 array of local wall-clock nanoseconds since 1970-01-01, boolean array of valid times
+    """
+    if isinstance(localtime.dtype, pd.DatetimeTZDtype):
+        wall = localtime.dt.tz_localize(None)
+    elif pd.api.types.is_datetime64_dtype(localtime.dtype):
+        wall = localtime
+    else:
+        # Mixed time zones after convert_to_local_time
+        wall = pd.to_datetime(localtime.map(lambda x: x.replace(tzinfo=None) if pd.notna(x) else pd.NaT))
+    return wall.values.astype('datetime64[ns]').view(np.int64), wall.notna().values
+
+
+def calendar_fields(wall_ns):
+    """
+    Calendar fields from local wall-clock times
+    :param wall_ns: int64 array, local wall-clock time as nanoseconds since 1970-01-01
+    :return: dict of arrays hour and the calendar columns
+    """
+    fields = day_attributes(np.floor_divide(wall_ns, ns_per_day))
+    fields['hour'] = np.floor_divide(wall_ns, 3600 * 10**9) % 24
+    return fields
+
+
+def state_holiday(state, dates):
+    """
+    School-holiday flag of (state, date) pairs, gathered from the calendar.
+    :param state: array-like of state names as in holidays.yaml
+    :param dates: array-like of dates
+    :return: int8 array, 1 for holidays, 0 otherwise (also for unknown states and days outside the calendar)
+    """
+    calendar = get_calendar()
+    states = [c[len('holiday_'):] for c in calendar.columns if c.startswith('holiday_')]
+    flags = np.vstack([calendar[f'holiday_{s}'].values for s in states] + [np.zeros(len(calendar), dtype=np.int8)])
+    codes = pd.Index(states).get_indexer(np.asarray(state, dtype=object))
+    idx = day_index(dates)
+    codes[idx < 0] = len(states)
+    return flags[codes, np.maximum(idx, 0)]
@@ -0,0 +1,155 @@
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pathlib import Path
+
+import partitioner
+import mad_store
+
+
+ROOT_dir = Path(__file__).parent.parent
+dictionary_folder = os.path.join(ROOT_dir, 'dbs/devices/dictionary')
+
+
+class DeviceDictionary:
+    def __init__(self, folder=dictionary_folder, num_shards=64, seed=68):
+        """
+        Persistent mapping of device_aid to a dense integer device_id shared by all stages.
+        Devices are sharded by partitioner.device_group; shard s is stored as folder/shard_{s}.parquet and
+        its k-th device gets device_id = k * num_shards + s, so ids never change once assigned, stay unique
+        across shards and fit int32 for up to ~2 billion devices.
+        :param folder: folder of the shard files
+        :param num_shards: int, number of shards (fixed for the lifetime of a dictionary)
+        :param seed: int, hash seed of the sharding
+        """
+        self.folder = folder
+        self.num_shards = num_shards
+        self.seed = seed
+        self.devices = dict()   # shard -> numpy array of device_aid, position = local index
+        self.index = dict()     # shard -> pd.Index over the same array
+        self.dirty = set()
+
+    def shard_file(self, shard=None):
+        return os.path.join(self.folder, f'shard_{shard}.parquet')
+
+    def load_from_disk(self, shard=None):
+        return pq.read_table(self.shard_file(shard), columns=['device_aid']).column('device_aid').\
+            to_numpy(zero_copy_only=False).astype(object)
+
+    def load_shard(self, shard=None):
+        if shard not in self.devices:
+            if os.path.isfile(self.shard_file(shard)):
+                devices = self.load_from_disk(shard)
+            else:
+                devices = np.array([], dtype=object)
+            self.devices[shard] = devices
+            self.index[shard] = pd.Index(devices)
+        return self.devices[shard]
+
+    def encode(self, device_aid, add=True):
+        """
+        :param device_aid: array-like of device_aid strings
+        :param add: boolean, if true, unseen devices get new ids (call save() before the ids are shared),
+        otherwise they are encoded as -1
+        :return: numpy array of int64 device ids
+        """
+        codes, uniques = pd.factorize(partitioner._to_object_array(device_aid))
+        shards = partitioner.device_group(uniques, num_groups=self.num_shards, seed=self.seed)
+        ids = np.full(len(uniques), -1, dtype=np.int64)
+        for shard in np.unique(shards):
+            mask = shards == shard
+            self.load_shard(shard)
+            local = self.index[shard].get_indexer(uniques[mask])
+            if add and (local < 0).any():
+                new = uniques[mask][local < 0]
+                local[local < 0] = np.arange(len(self.devices[shard]), len(self.devices[shard]) + len(new))
+                self.devices[shard] = np.concatenate([self.devices[shard], new])
+                self.index[shard] = pd.Index(self.devices[shard])
+                self.dirty.add(shard)
+            ids[mask] = np.where(local >= 0, local * self.num_shards + shard, -1)
+        return np.where(codes >= 0, ids[codes], -1)
+
+    def decode(self, device_id):
+        """
+        :param device_id: array-like of int device ids
+        :return: numpy array of device_aid strings, None for unknown ids
+        """
+        device_id = np.asarray(device_id, dtype=np.int64)
+        out = np.full(len(device_id), None, dtype=object)
+        shards, local = device_id % self.num_shards, device_id // self.num_shards
+        for shard in np.unique(shards[device_id >= 0]):
+            devices = self.load_shard(shard)
+            mask = (shards == shard) & (device_id >= 0) & (local < len(devices))
+            out[mask] = devices[local[mask]]
+        return out
+
+    def save(self, timeout=600):
+        """
+        Write the shards with new devices. A shard is locked while it is written and must not have been
+        extended on disk by another process since it was loaded; run dictionary updates from one process.
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        for shard in sorted(self.dirty):
+            file_path = self.shard_file(shard)
+            with mad_store.file_lock(file_path, timeout=timeout):
+                if os.path.isfile(file_path):
+                    on_disk = self.load_from_disk(shard)
+                    if not np.array_equal(self.devices[shard][:len(on_disk)], on_disk):
+                        raise RuntimeError(f'{file_path} was changed by another process, reload and encode again')
+                devices = self.devices[shard]
+                table = pa.table({'device_aid': pa.array(devices, type=pa.string()),
+                                  'device_id': pa.array(np.arange(len(devices)) * self.num_shards + shard,
+                                                        type=pa.int64())})
+                tmp_path = mad_store.temp_file(file_path)
+                pq.write_table(table, tmp_path, compression='zstd')
+                os.replace(tmp_path, file_path)
+        print(f'Device dictionary saved ({len(self.dirty)} shards updated).')
+        self.dirty = set()
+
+    def with_ids(self, df=None, keep_aid=False):
+        """
+        Frame keyed by device_id: frames written before the device_id column was added are encoded (new devices
+        are added and saved), and device_aid is dropped so only the integer key is carried.
+        :param df: dataframe with device_aid and/or device_id
+        :param keep_aid: boolean, if true, device_aid is kept
+        :return: dataframe
+        """
+        if 'device_id' not in df.columns:
+            df.insert(0, 'device_id', self.encode(df['device_aid'], add=True))
+            self.save()
+        if not keep_aid and 'device_aid' in df.columns:
+            df = df.drop(columns='device_aid')
+        return df
+
+    def read_parquet(self, file_path=None, columns=None):
+        """
+        Read a stage output keyed by device_id; device_aid is only read from files written before the device_id
+        column was added, to encode them (see with_ids).
+        :param columns: list of columns besides the device key, None for all
+        :return: dataframe with device_id and without device_aid
+        """
+        names = pq.read_schema(file_path).names
+        if columns is None:
+            columns = [x for x in names if x not in ('device_aid', 'device_id') and not x.startswith('__index_level_')]
+        key = 'device_id' if 'device_id' in names else 'device_aid'
+        return self.with_ids(pd.read_parquet(file_path, columns=[key] + list(columns)))
+
+    def with_aids(self, df=None):
+        """
+        Decode device_id back to device_aid (first column) where a frame leaves the pipeline (database, output files).
+        :param df: dataframe with device_id
+        :return: dataframe
+        """
+        df = df.drop(columns='device_aid', errors='ignore')
+        df.insert(0, 'device_aid', self.decode(df['device_id'].values))
+        return df
+
+    def update_from_files(self, file_paths=None):
+        """
+        Register the devices of converted parquet files (only the device_aid column is read) and save.
+        """
+        for file_path in file_paths:
+            self.encode(pq.read_table(file_path, columns=['device_aid']).column('device_aid').unique(), add=True)
+        self.save()
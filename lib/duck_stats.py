@@ -0,0 +1,165 @@
+import duckdb
+import pyarrow as pa
+import pg_writer
+import partitioner
+import hll
+
+
+de_box = (5.98865807458, 47.3024876979, 15.0169958839, 54.983104153)
+# Hash seed of the device sub-groups (grp) of a batch, shared by both stage 3 backends; it differs from the
+# seed of the batches, whose devices would otherwise all fall into the same sub-group
+grp_seed = 11
+
+devices_sql = "SELECT DISTINCT device_aid FROM read_parquet({files}, union_by_name = true)"
+
+# Same steps as TimeProcessing.time_processing + time_enrich: keep records in the Germany box, convert to
+# Berlin time and derive the calendar fields; grp comes from the registered device_groups table
+records_sql = """
+CREATE OR REPLACE TEMP TABLE records AS
+SELECT device_aid, ts AS timestamp,
+       CAST(lt AS DATE) AS date, hour(lt) AS hour, month(lt) AS month, year(lt) AS year,
+       isodow(lt) - 1 AS weekday, week(lt) AS week, grp
+FROM (SELECT device_aid, CAST(timestamp AS BIGINT) AS ts,
+             timezone('Europe/Berlin', to_timestamp(CAST(timestamp AS BIGINT))) AS lt
+      FROM read_parquet({files}, union_by_name = true)
+      WHERE latitude BETWEEN {lat_min} AND {lat_max} AND longitude BETWEEN {lon_min} AND {lon_max})
+JOIN device_groups USING (device_aid)
+"""
+
+
+def device_groups(device_aid=None, num_grps=None):
+    """
+    Sub-group of each device of a batch, the grp column of the statistics tables.
+    :param device_aid: array-like of device_aid strings
+    :param num_grps: int, number of sub-groups
+    :return: int32 array of groups in [0, num_grps)
+    """
+    return partitioner.device_group(device_aid, num_groups=num_grps, seed=grp_seed).astype('int32')
+
+hourly_sql = """
+SELECT date, hour, any_value(week) AS week, any_value(weekday) AS weekday,
+       count(DISTINCT device_aid) AS device_count, count(*) AS rec_count, {batch} AS batch, grp
+FROM records
+GROUP BY grp, date, hour
+ORDER BY grp, date, hour
+"""
+
+ym_sql = """
+SELECT year, month, count(DISTINCT device_aid) AS device_count, count(*) AS rec_count, {batch} AS batch, grp
+FROM records
+GROUP BY grp, year, month
+ORDER BY grp, year, month
+"""
+
+# q_completeness: weeks are keyed by ISO week number, q_hour_sd is the sample sd and 0 for one week
+individual_sql = """
+WITH device_week AS (
+    SELECT grp, device_aid, count(DISTINCT weekday * 24 + hour) / 168 AS q_hour
+    FROM records
+    GROUP BY grp, device_aid, week),
+device_q AS (
+    SELECT grp, device_aid, avg(q_hour) AS q_hour_m,
+           CASE WHEN count(*) > 1 THEN stddev_samp(q_hour) ELSE 0 END AS q_hour_sd
+    FROM device_week
+    GROUP BY grp, device_aid),
+device_days AS (
+    SELECT grp, device_aid, count(DISTINCT date) AS no_active_days,
+           ceil((max(timestamp) - min(timestamp)) / 3600 / 24 + 1) AS total_days, count(*) AS no_rec
+    FROM records
+    GROUP BY grp, device_aid)
+SELECT d.device_aid, CAST(d.no_active_days AS DOUBLE) AS no_active_days, d.total_days,
+       d.no_active_days / greatest(d.total_days, 1) AS q_day, q.q_hour_m, q.q_hour_sd,
+       CAST(d.no_rec AS DOUBLE) AS no_rec, {batch} AS batch, d.grp
+FROM device_days d JOIN device_q q USING (grp, device_aid)
+ORDER BY d.grp, d.device_aid
+"""
+
+
+class DuckStatsCompute:
+    def __init__(self, reader=None, num_grps=20, batch=0, threads=18, memory_limit='48GB', temp_directory=None):
+        """
+        Stage 3 statistics on an embedded DuckDB database, read directly from the parquet store
+        (the same output tables as StatsCompute, without a JVM or per-group pandas conversion).
+        :param reader: mad_store.StoreReader of the converted data
+        :param num_grps: int, number of device sub-groups per batch (the grp column of the output)
+        :param batch: int, device group of the store
+        :param threads: int, DuckDB threads
+        :param memory_limit: str, DuckDB memory limit, larger intermediates spill to temp_directory
+        :param temp_directory: str, spill folder
+        """
+        self.reader = reader
+        self.num_grps = num_grps
+        self.batch = batch
+        self.con = duckdb.connect()
+        self.con.execute(f"SET threads = {int(threads)}")
+        self.con.execute(f"SET memory_limit = '{memory_limit}'")
+        if temp_directory is not None:
+            self.con.execute(f"SET temp_directory = '{temp_directory}'")
+
+    def load_data(self):
+        print(f"Preparing data batch {self.batch}")
+        files = self.reader.file_list(groups=[self.batch])
+        file_list = '[' + ', '.join("'" + f.replace("'", "''") + "'" for f in files) + ']'
+        devices = self.con.execute(devices_sql.format(files=file_list)).df()['device_aid'].values
+        self.con.register('device_groups', pa.table({'device_aid': devices,
+                                                     'grp': device_groups(devices, num_grps=self.num_grps)}))
+        self.con.execute(records_sql.format(files=file_list, lon_min=de_box[0], lat_min=de_box[1],
+                                            lon_max=de_box[2], lat_max=de_box[3]))
+        self.con.unregister('device_groups')
+        print('Data loaded.')
+
+    def stats_hourly(self):
+        df = self.con.execute(hourly_sql.format(batch=int(self.batch))).df()
+        df['date'] = df['date'].dt.date
+        return df
+
+    def stats_ym(self):
+        return self.con.execute(ym_sql.format(batch=int(self.batch))).df()
+
+    def stats_individual(self):
+        return self.con.execute(individual_sql.format(batch=int(self.batch))).df()
+
+    def sketches(self):
+        """
+        Device sketches per (grp, date, hour) and (grp, year, month), the same as hll.build_sketches on the records.
+        :return: dict of level -> dataframe of bucket columns, sketch, batch and grp
+        """
+        devices = self.con.execute("SELECT DISTINCT device_aid FROM records").df()['device_aid'].values
+        idx, rho = hll.device_registers(devices)
+        self.con.register('device_registers', pa.table({'device_aid': devices, 'idx': idx, 'rho': rho}))
+        out = dict()
+        for level, cols in (('raw_hourly', ['date', 'hour']), ('raw_monthly', ['year', 'month'])):
+            keys = ', '.join(['grp'] + cols)
+            registers = self.con.execute(f"""SELECT {keys}, idx, max(rho) AS rho
+                                              FROM records JOIN device_registers USING (device_aid)
+                                              GROUP BY {keys}, idx""").df()
+            sketches = hll.build_sketches(registers[['grp'] + cols], registers['idx'].values.astype('int64'),
+                                          registers['rho'].values.astype('uint8'))
+            if 'date' in cols:
+                sketches['date'] = sketches['date'].dt.date
+            sketches.insert(len(cols) + 1, 'batch', self.batch)
+            out[level] = sketches[cols + ['sketch', 'batch', 'grp']]
+        self.con.unregister('device_registers')
+        return out
+
+    def update_activity(self, cube=None, dictionary=None):
+        """
+        Add the active device-hours of the records to an activity cube and save it. Devices missing from the
+        dictionary are registered (the dictionary is saved before the cube).
+        :param cube: activity_cube.ActivityCube
+        :param dictionary: device_dict.DeviceDictionary
+        """
+        df = self.con.execute("SELECT DISTINCT device_aid, date, hour FROM records").df()
+        cube.update(device_id=dictionary.encode(df['device_aid'], add=True), dates=df['date'], hours=df['hour'])
+        dictionary.save()
+        cube.save()
+
+    def compute(self, engine=None):
+        print("Saving data stats..")
+        pg_writer.write_frame(self.stats_hourly(), 'raw', schema='data_desc', engine=engine)
+        pg_writer.write_frame(self.stats_ym(), 'raw_ym', schema='data_desc', engine=engine)
+        print("Saving individual stats..")
+        pg_writer.write_frame(self.stats_individual(), 'raw_indi', schema='data_desc', engine=engine)
+        for level, sketches in self.sketches().items():
+            hll.save_sketches(sketches, level=level, name=f'batch_{self.batch}')
+        self.con.execute("DROP TABLE IF EXISTS records")
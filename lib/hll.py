@@ -0,0 +1,147 @@
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pathlib import Path
+
+import partitioner
+import mad_store
+
+
+ROOT_dir = Path(__file__).parent.parent
+sketch_folder = os.path.join(ROOT_dir, 'dbs/sketches')
+precision = 14      # 2^14 registers, ~0.8% standard error
+hll_seed = 101      # independent of the device grouping hash (seed 68)
+sparse_dtype = np.dtype([('idx', '<u2'), ('rho', 'u1')])
+
+
+def leading_zeros(x):
+    """
+    :param x: uint64 array
+    :return: int64 array, number of leading zero bits (64 for 0)
+    """
+    hi, lo = (x >> np.uint64(32)).astype(np.float64), (x & np.uint64(0xFFFFFFFF)).astype(np.float64)
+    # frexp is exact for 32-bit integers: x = m * 2^e with m in [0.5, 1), so the bit length is e
+    _, e_hi = np.frexp(hi)
+    _, e_lo = np.frexp(lo)
+    return np.where(hi > 0, 32 - e_hi, 64 - e_lo).astype(np.int64)
+
+
+def device_registers(device_aid, p=precision):
+    """
+    HyperLogLog register index and rank of each device
+    :param device_aid: array-like of device_aid strings
+    :param p: int, precision (number of index bits)
+    :return: int64 array of register indices, uint8 array of ranks
+    """
+    codes, uniques = pd.factorize(partitioner._to_object_array(device_aid))
+    h = partitioner.device_hash(uniques, seed=hll_seed)
+    idx = (h >> np.uint64(64 - p)).astype(np.int64)
+    rho = np.minimum(leading_zeros(h << np.uint64(p)), 64 - p) + 1
+    return idx[codes], rho[codes].astype(np.uint8)
+
+
+def encode(idx=None, rho=None, p=precision):
+    """
+    Serialize the non-empty registers of one sketch: sparse (idx, rho) pairs, or all 2^p registers
+    when that is smaller. The two forms are told apart by length (3 * k never equals 2^p).
+    """
+    m = 1 << p
+    if 3 * len(idx) < m:
+        pairs = np.empty(len(idx), dtype=sparse_dtype)
+        pairs['idx'], pairs['rho'] = idx, rho
+        return pairs.tobytes()
+    registers = np.zeros(m, dtype=np.uint8)
+    registers[idx] = rho
+    return registers.tobytes()
+
+
+def decode(blob=None, p=precision):
+    """
+    :return: uint8 array of the 2^p registers
+    """
+    m = 1 << p
+    if len(blob) == m:
+        return np.frombuffer(blob, dtype=np.uint8).copy()
+    pairs = np.frombuffer(blob, dtype=sparse_dtype)
+    registers = np.zeros(m, dtype=np.uint8)
+    np.maximum.at(registers, pairs['idx'].astype(np.int64), pairs['rho'])
+    return registers
+
+
+def merge(blobs=None, p=precision):
+    """
+    Union of sketches: register-wise maximum.
+    """
+    registers = np.zeros(1 << p, dtype=np.uint8)
+    for blob in blobs:
+        np.maximum(registers, decode(blob, p), out=registers)
+    return registers
+
+
+def estimate(registers=None):
+    """
+    HyperLogLog cardinality estimate with linear counting for small cardinalities.
+    """
+    m = len(registers)
+    alpha = 0.7213 / (1 + 1.079 / m)
+    e = alpha * m * m / np.sum(np.ldexp(1.0, -registers.astype(np.int64)))
+    zeros = int((registers == 0).sum())
+    if e <= 2.5 * m and zeros > 0:
+        return m * np.log(m / zeros)
+    return e
+
+
+def build_sketches(keys=None, idx=None, rho=None, p=precision):
+    """
+    One sketch per distinct row of keys.
+    :param keys: dataframe of bucket columns (e.g., date and hour), one row per record
+    :param idx: register indices of the records (device_registers)
+    :param rho: ranks of the records
+    :return: dataframe of the bucket columns and sketch (bytes)
+    """
+    cols = list(keys.columns)
+    grouped = keys.groupby(cols, sort=True)
+    bucket = grouped.ngroup().values.astype(np.int64)
+    buckets = keys.drop_duplicates().sort_values(cols).reset_index(drop=True)
+    key = bucket * (1 << p) + idx
+    order = np.argsort(key, kind='stable')
+    key, rho = key[order], rho[order]
+    starts = np.flatnonzero(np.r_[True, key[1:] != key[:-1]])
+    key, rho = key[starts], np.maximum.reduceat(rho, starts)
+    bucket, idx = key >> p, key & ((1 << p) - 1)
+    bounds = np.searchsorted(bucket, np.arange(len(buckets) + 1))
+    buckets['sketch'] = [encode(idx[a:b], rho[a:b], p) for a, b in zip(bounds[:-1], bounds[1:])]
+    return buckets
+
+
+def save_sketches(sketches=None, level=None, name=None, folder=sketch_folder):
+    """
+    Write sketches atomically to folder/level/name.parquet; files of a level can come from any batch,
+    group or data delivery and are merged on read.
+    """
+    file_path = os.path.join(folder, level, f'{name}.parquet')
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    tmp_path = mad_store.temp_file(file_path)
+    pq.write_table(pa.Table.from_pandas(sketches, preserve_index=False), tmp_path, compression='zstd')
+    os.replace(tmp_path, file_path)
+
+
+def read_sketches(level=None, folder=sketch_folder):
+    level_folder = os.path.join(folder, level)
+    return pd.concat([pd.read_parquet(os.path.join(level_folder, f)) for f in sorted(os.listdir(level_folder))
+                      if f.endswith('.parquet')], ignore_index=True)
+
+
+def distinct_count(sketches=None, by=None, p=precision):
+    """
+    Distinct devices per bucket of by, from the union of the sketches in each bucket.
+    :param sketches: dataframe with the bucket columns and sketch
+    :param by: list of columns to count by (e.g., ['date'] for daily counts from hourly sketches), None for total
+    :return: dataframe of by and device_count
+    """
+    if not by:
+        return pd.DataFrame(dict(device_count=[estimate(merge(sketches['sketch'], p))]))
+    return sketches.groupby(by)['sketch'].apply(lambda x: estimate(merge(x, p))).\
+        rename('device_count').reset_index()
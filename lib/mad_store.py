@@ -0,0 +1,446 @@
+import os
+import json
+import time
+import hashlib
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+
+# Converted MAD data are stored as root/grp={grp}/year={year}/month={month}/day={day}/part-{part}.parquet
+# and every written file has an entry in root/_manifest/{year}-{month}-{day}_part-{part}.json
+partition_cols = ['grp', 'year', 'month', 'day']
+manifest_dir = '_manifest'
+sort_cols = [('device_aid', 'ascending'), ('timestamp', 'ascending')]
+
+
+def partition_dir(root=None, grp=None, year=None, month=None, day=None):
+    return os.path.join(root, f'grp={int(grp)}', f'year={int(year)}', f'month={int(month)}', f'day={int(day)}')
+
+
+def partition_file(root=None, grp=None, year=None, month=None, day=None, part=0):
+    return os.path.join(partition_dir(root=root, grp=grp, year=year, month=month, day=day), f'part-{part}.parquet')
+
+
+def temp_file(file_path=None):
+    # Dot-prefixed, so readers of the store never pick up unfinished files
+    folder, name = os.path.split(file_path)
+    return os.path.join(folder, f'.{name}.{os.getpid()}.tmp')
+
+
+@contextmanager
+def file_lock(file_path=None, timeout=600):
+    """
+    Exclusive lock on file_path (a file_path + '.lock' file created with O_EXCL), held inside the with block.
+    :param timeout: seconds to wait for the lock before a TimeoutError
+    """
+    lock = file_path + '.lock'
+    start = time.time()
+    while True:
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            if time.time() - start > timeout:
+                raise TimeoutError(f'Could not lock {file_path}')
+            time.sleep(1)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        os.remove(lock)
+
+
+def file_checksum(file_path=None, chunk_size=16 << 20):
+    h = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def commit_file(tmp_path=None, file_path=None, root=None, grp=None, year=None, month=None, day=None, part=0,
+                rows=None, sources=None):
+    """
+    Move a completely written temporary file to its final path and describe it for the manifest.
+    :return: dict, manifest entry of the file
+    """
+    entry = dict(path=os.path.relpath(file_path, root), grp=int(grp), year=int(year), month=int(month),
+                 day=int(day), part=int(part), rows=int(rows), bytes=os.path.getsize(tmp_path),
+                 checksum=file_checksum(tmp_path), sources=[os.path.basename(x) for x in (sources or [])])
+    os.replace(tmp_path, file_path)
+    return entry
+
+
+def empty_entry(root=None, grp=None, year=None, month=None, day=None, part=0, sources=None):
+    """
+    Manifest entry of a group without rows in a (day, part): no file is written, but the group is accounted for.
+    """
+    file_path = partition_file(root=root, grp=grp, year=year, month=month, day=day, part=part)
+    return dict(path=os.path.relpath(file_path, root), grp=int(grp), year=int(year), month=int(month),
+                day=int(day), part=int(part), rows=0, bytes=0, checksum=None,
+                sources=[os.path.basename(x) for x in (sources or [])])
+
+
+def manifest_file(root=None, year=None, month=None, day=None, part=0):
+    return os.path.join(root, manifest_dir, f'{int(year)}-{int(month):02d}-{int(day):02d}_part-{int(part)}.json')
+
+
+def update_manifest(root=None, year=None, month=None, day=None, part=0, entries=None):
+    """
+    Add entries to the manifest of one (day, part); entries of re-written files replace the old ones.
+    The manifest file itself is replaced atomically.
+    """
+    file_path = manifest_file(root=root, year=year, month=month, day=day, part=part)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    merged = dict()
+    if os.path.isfile(file_path):
+        with open(file_path) as f:
+            merged = {x['path']: x for x in json.load(f)}
+    for entry in entries:
+        merged[entry['path']] = entry
+    tmp_path = temp_file(file_path)
+    with open(tmp_path, 'w') as f:
+        json.dump(sorted(merged.values(), key=lambda x: x['grp']), f)
+    os.replace(tmp_path, file_path)
+
+
+def read_manifest(root=None, empty=False):
+    """
+    :param empty: boolean, if true, groups recorded without rows (no file, see empty_entry) are included
+    :return: dataframe of the manifest entries
+    """
+    folder = os.path.join(root, manifest_dir)
+    entries = []
+    if os.path.isdir(folder):
+        for file in os.listdir(folder):
+            if file.endswith('.json'):
+                with open(os.path.join(folder, file)) as f:
+                    entries += json.load(f)
+    manifest = pd.DataFrame(entries, columns=['path', 'grp', 'year', 'month', 'day', 'part',
+                                              'rows', 'bytes', 'checksum', 'sources'])
+    return manifest if empty else manifest.loc[manifest['rows'] > 0].reset_index(drop=True)
+
+
+def verify_store(root=None, level='size', days=None, num_groups=None):
+    """
+    Check the converted files against the manifest instead of parsing them.
+    :param root: root folder of the store
+    :param level: 'size' compares file sizes (stat only), 'footer' also compares the row count in the parquet
+    footer, 'checksum' re-hashes every file
+    :param days: list of (year, month, day) expected in the store, days without any manifest entry are reported
+    :param num_groups: int, if given, every recorded (day, part) is expected to hold groups 0..num_groups-1,
+    either as a file or as a group recorded without rows
+    :return: dataframe of grp, year, month, day, part, path, problem; grp is -1 for a missing day
+    """
+    manifest = read_manifest(root=root, empty=True)
+    problems = []
+    for entry in manifest.itertuples(index=False):
+        if entry.rows == 0:
+            continue
+        file_path = os.path.join(root, entry.path)
+        problem = None
+        if not os.path.isfile(file_path):
+            problem = 'missing file'
+        elif os.path.getsize(file_path) != entry.bytes:
+            problem = 'size mismatch'
+        elif level in ('footer', 'checksum'):
+            try:
+                if pq.read_metadata(file_path).num_rows != entry.rows:
+                    problem = 'row count mismatch'
+            except Exception:
+                problem = 'unreadable footer'
+        if (problem is None) and (level == 'checksum') and (file_checksum(file_path) != entry.checksum):
+            problem = 'checksum mismatch'
+        if problem is not None:
+            problems.append((entry.grp, entry.year, entry.month, entry.day, entry.part, entry.path, problem))
+    if num_groups is not None:
+        for (y, m, d, part), grps in manifest.groupby(['year', 'month', 'day', 'part'])['grp']:
+            for g in sorted(set(range(num_groups)) - set(grps)):
+                problems.append((g, y, m, d, part, None, 'missing partition'))
+    if days is not None:
+        recorded = set(zip(manifest['year'], manifest['month'], manifest['day']))
+        for y, m, d in days:
+            if (int(y), int(m), int(d)) not in recorded:
+                problems.append((-1, int(y), int(m), int(d), 0, None, 'missing day'))
+    problems = pd.DataFrame(problems, columns=['grp', 'year', 'month', 'day', 'part', 'path', 'problem'])
+    print(f"Checked {(manifest['rows'] > 0).sum()} files: {len(problems)} problems.")
+    return problems
+
+
+def split_by_group(table=None, grp=None):
+    """
+    Reorder the rows of table by group and return the slice of every group.
+    :param table: pyarrow.Table
+    :param grp: array of group ids aligned with table rows, negative for rows without a group
+    :return: generator of (grp, pyarrow.Table)
+    """
+    order = np.argsort(grp, kind='stable')
+    grp_sorted = grp[order]
+    table = table.take(pa.array(order))
+    keys, starts = np.unique(grp_sorted, return_index=True)
+    ends = np.append(starts[1:], len(grp_sorted))
+    for g, s, e in zip(keys, starts, ends):
+        if g >= 0:
+            yield int(g), table.slice(s, e - s)
+
+
+def sort_devices(table=None):
+    return table.take(pc.sort_indices(table, sort_keys=[x for x in sort_cols if x[0] in table.column_names]))
+
+
+def write_partitioned(table=None, root=None, year=None, month=None, day=None, part=0,
+                      row_group_size=1 << 20, compression='zstd', sources=None, groups=None):
+    """
+    Write one day of records into the hive-style store in one call: rows are split by their grp column,
+    sorted by device and time, and each group goes to its own day partition. Only the target partition
+    directories are created, the existing tree is never listed. Files are written to a temporary name,
+    renamed when complete and recorded in the manifest.
+    :param table: pyarrow.Table or pandas.DataFrame with a grp column
+    :param root: root folder of the store
+    :param part: int, file index inside the day partition (e.g., the half of the raw files)
+    :param row_group_size: int, maximum rows per parquet row group
+    :param compression: str, parquet compression codec
+    :param sources: list of raw files the records come from
+    :param groups: groups the day is written for, those without rows are recorded as empty (empty_entry)
+    :return: dict of grp -> number of rows written
+    """
+    if not isinstance(table, pa.Table):
+        table = pa.Table.from_pandas(table, preserve_index=False)
+    grp = table.column('grp').to_numpy(zero_copy_only=False)
+    rows = dict()
+    entries = []
+    for g, data in split_by_group(table=table.drop_columns(['grp']), grp=grp):
+        file_path = partition_file(root=root, grp=g, year=year, month=month, day=day, part=part)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        tmp_path = temp_file(file_path)
+        pq.write_table(sort_devices(data), tmp_path, row_group_size=row_group_size, compression=compression)
+        entries.append(commit_file(tmp_path=tmp_path, file_path=file_path, root=root, grp=g, year=year,
+                                   month=month, day=day, part=part, rows=data.num_rows, sources=sources))
+        rows[g] = data.num_rows
+    entries += [empty_entry(root=root, grp=g, year=year, month=month, day=day, part=part, sources=sources)
+                for g in (groups or []) if g not in rows]
+    update_manifest(root=root, year=year, month=month, day=day, part=part, entries=entries)
+    return rows
+
+
+class PartitionedDayWriter:
+    def __init__(self, root=None, year=None, month=None, day=None, part=0,
+                 memory_budget=2 << 30, row_group_size=1 << 20, compression='zstd', sources=None, groups=None):
+        """
+        Streaming counterpart of write_partitioned: rows of one day are buffered per group and appended
+        as device-sorted row groups to the group's day partition once the buffered bytes exceed memory_budget.
+        Files only get their final name, and a manifest entry, when the writer is closed.
+        :param root: root folder of the store
+        :param part: int, file index inside the day partition
+        :param memory_budget: int, maximum bytes of rows buffered before flushing
+        :param row_group_size: int, maximum rows per parquet row group
+        :param compression: str, parquet compression codec
+        :param sources: list of raw files the records come from
+        :param groups: groups the day is written for, those without rows are recorded as empty (empty_entry)
+        """
+        self.root = root
+        self.year, self.month, self.day, self.part = year, month, day, part
+        self.memory_budget = memory_budget
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.sources = sources
+        self.groups = groups
+        self.buffers = dict()
+        self.buffered = 0
+        self.writers = dict()
+        self.rows = dict()
+
+    def write(self, table=None, grp=None):
+        """
+        :param table: pyarrow.Table without the grp column
+        :param grp: array of group ids aligned with table rows, -1 for devices without a group
+        """
+        for g, piece in split_by_group(table=table, grp=grp):
+            self.buffers.setdefault(g, []).append(piece)
+            self.buffered += piece.nbytes
+        if self.buffered > self.memory_budget:
+            self.flush()
+
+    def flush(self):
+        for g, pieces in self.buffers.items():
+            data = sort_devices(pa.concat_tables(pieces))
+            if g not in self.writers:
+                file_path = partition_file(root=self.root, grp=g, year=self.year, month=self.month,
+                                           day=self.day, part=self.part)
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                self.writers[g] = pq.ParquetWriter(temp_file(file_path), data.schema, compression=self.compression)
+            self.writers[g].write_table(data, row_group_size=self.row_group_size)
+            self.rows[g] = self.rows.get(g, 0) + data.num_rows
+        self.buffers = dict()
+        self.buffered = 0
+
+    def close(self):
+        self.flush()
+        entries = []
+        for g, writer in self.writers.items():
+            writer.close()
+            file_path = partition_file(root=self.root, grp=g, year=self.year, month=self.month,
+                                       day=self.day, part=self.part)
+            entries.append(commit_file(tmp_path=temp_file(file_path), file_path=file_path, root=self.root, grp=g,
+                                       year=self.year, month=self.month, day=self.day, part=self.part,
+                                       rows=self.rows[g], sources=self.sources))
+        entries += [empty_entry(root=self.root, grp=g, year=self.year, month=self.month, day=self.day,
+                                part=self.part, sources=self.sources)
+                    for g in (self.groups or []) if g not in self.rows]
+        update_manifest(root=self.root, year=self.year, month=self.month, day=self.day, part=self.part,
+                        entries=entries)
+        self.writers = dict()
+        return self.rows
+
+
+def parse_date(x=None):
+    return None if x is None else pd.Timestamp(x).date()
+
+
+class StoreReader:
+    def __init__(self, roots=None):
+        """
+        Read converted MAD data by (groups, date range, columns) from one or several stores. A store is either
+        hive-style (grp=/year=/month=/day=, see write_partitioned) or the legacy layout grp_{grp}/{y}_{m}_{d}_{hf}.parquet
+        (format_parquet_r, format_parquet_br); the layout is detected from the root folder.
+        :param roots: list of root folders
+        """
+        self.roots = roots
+        self.layouts = {root: self.detect_layout(root) for root in roots}
+
+    @staticmethod
+    def detect_layout(root=None):
+        if os.path.isdir(os.path.join(root, manifest_dir)):
+            return 'hive'
+        for entry in os.scandir(root):
+            if entry.name.startswith('grp='):
+                return 'hive'
+            if entry.name.startswith('grp_'):
+                return 'legacy'
+        return 'hive'
+
+    @staticmethod
+    def in_range(date=None, start=None, end=None):
+        return ((start is None) or (date >= start)) and ((end is None) or (date <= end))
+
+    def files_hive(self, root=None, groups=None, start=None, end=None):
+        if os.path.isdir(os.path.join(root, manifest_dir)):
+            manifest = read_manifest(root=root)
+            if groups is not None:
+                manifest = manifest.loc[manifest['grp'].isin(groups)]
+            keep = [self.in_range(pd.Timestamp(year=y, month=m, day=d).date(), start, end)
+                    for y, m, d in zip(manifest['year'], manifest['month'], manifest['day'])]
+            manifest = manifest.loc[keep]
+            return {g: [os.path.join(root, x) for x in df['path']] for g, df in manifest.groupby('grp')}
+        # Without a manifest, only the partition directories inside the date range are listed
+        if groups is None:
+            groups = [int(x.split('=')[1]) for x in os.listdir(root) if x.startswith('grp=')]
+        files = dict()
+        for g in groups:
+            grp_dir = os.path.join(root, f'grp={g}')
+            if not os.path.isdir(grp_dir):
+                continue
+            for year in sorted(os.listdir(grp_dir)):
+                y = int(year.split('=')[1])
+                if (start is not None and y < start.year) or (end is not None and y > end.year):
+                    continue
+                for month in sorted(os.listdir(os.path.join(grp_dir, year))):
+                    m = int(month.split('=')[1])
+                    if not self.in_range((y, m), start and (start.year, start.month), end and (end.year, end.month)):
+                        continue
+                    for day in sorted(os.listdir(os.path.join(grp_dir, year, month))):
+                        d = int(day.split('=')[1])
+                        if self.in_range(pd.Timestamp(year=y, month=m, day=d).date(), start, end):
+                            folder = os.path.join(grp_dir, year, month, day)
+                            files.setdefault(g, []).extend(os.path.join(folder, x) for x in sorted(os.listdir(folder))
+                                                           if x.endswith('.parquet'))
+        return files
+
+    def files_legacy(self, root=None, groups=None, start=None, end=None):
+        if groups is None:
+            groups = [int(x.split('_')[-1]) for x in os.listdir(root) if x.startswith('grp_')]
+        files = dict()
+        for g in groups:
+            folder = os.path.join(root, f'grp_{g}')
+            if not os.path.isdir(folder):
+                continue
+            for file in sorted(os.listdir(folder)):
+                y, m, d = file.split('_')[:3]
+                if file.endswith('.parquet') and \
+                        self.in_range(pd.Timestamp(year=int(y), month=int(m), day=int(d)).date(), start, end):
+                    files.setdefault(g, []).append(os.path.join(folder, file))
+        return files
+
+    def files(self, groups=None, start=None, end=None):
+        """
+        :param groups: list of groups, None for all
+        :param start: first day (str 'YYYY-MM-DD' or date), None for no lower bound
+        :param end: last day (inclusive), None for no upper bound
+        :return: dict of root -> dict of grp -> list of files
+        """
+        start, end = parse_date(start), parse_date(end)
+        files = dict()
+        for root in self.roots:
+            if self.layouts[root] == 'hive':
+                files[root] = self.files_hive(root=root, groups=groups, start=start, end=end)
+            else:
+                files[root] = self.files_legacy(root=root, groups=groups, start=start, end=end)
+        return files
+
+    def file_list(self, groups=None, start=None, end=None):
+        return [f for by_grp in self.files(groups=groups, start=start, end=end).values()
+                for grp_files in by_grp.values() for f in grp_files]
+
+    def datasets(self, groups=None, start=None, end=None):
+        import pyarrow.dataset as ds
+        out = []
+        for root, by_grp in self.files(groups=groups, start=start, end=end).items():
+            file_paths = [f for grp_files in by_grp.values() for f in grp_files]
+            if not file_paths:
+                continue
+            if self.layouts[root] == 'hive':
+                out.append(ds.dataset(file_paths, format='parquet', partition_base_dir=root,
+                                      partitioning=ds.partitioning(pa.schema([(x, pa.int32()) for x in partition_cols]),
+                                                                   flavor='hive')))
+            else:
+                out.append(ds.dataset(file_paths, format='parquet'))
+        return out
+
+    def iter_batches(self, groups=None, start=None, end=None, columns=None, filter=None, batch_size=1 << 20):
+        """
+        Stream record batches; only the requested columns are decoded and row groups whose statistics
+        cannot match filter (e.g., ds.field('timestamp') >= t) are skipped.
+        :param columns: list of column names
+        :param filter: pyarrow.dataset expression
+        :return: generator of pyarrow.RecordBatch
+        """
+        for dataset in self.datasets(groups=groups, start=start, end=end):
+            for batch in dataset.to_batches(columns=columns, filter=filter, batch_size=batch_size):
+                yield batch
+
+    def read_table(self, groups=None, start=None, end=None, columns=None, filter=None):
+        """
+        :return: pyarrow.Table of the requested groups, days and columns
+        """
+        tables = [dataset.to_table(columns=columns, filter=filter)
+                  for dataset in self.datasets(groups=groups, start=start, end=end)]
+        if not tables:
+            return pa.table({c: pa.array([]) for c in (columns or [])})
+        return pa.concat_tables(tables, promote_options='permissive')
+
+    def iter_pandas(self, groups=None, start=None, end=None, columns=None, filter=None, batch_size=1 << 20):
+        for batch in self.iter_batches(groups=groups, start=start, end=end, columns=columns, filter=filter,
+                                       batch_size=batch_size):
+            yield batch.to_pandas()
+
+    def spark_dataframe(self, spark=None, groups=None, start=None, end=None, columns=None):
+        """
+        :param spark: SparkSession
+        :return: Spark DataFrame over the minimal file list, restricted to columns
+        """
+        df = spark.read.parquet(*self.file_list(groups=groups, start=start, end=end))
+        return df.select(*columns) if columns is not None else df
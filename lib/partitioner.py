@@ -0,0 +1,94 @@
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from pathlib import Path
+
+
+ROOT_dir = Path(__file__).parent.parent
+legacy_grp_file = os.path.join(ROOT_dir, 'dbs/devices/devices_grp.parquet')
+
+
+def _to_object_array(device_aid):
+    if isinstance(device_aid, (pa.Array, pa.ChunkedArray)):
+        return device_aid.to_numpy(zero_copy_only=False).astype(object)
+    return np.asarray(device_aid, dtype=object)
+
+
+def device_hash(device_aid, seed=68):
+    """
+    Deterministic, seeded 64-bit hash of device ids (SipHash via pandas, vectorized).
+    :param device_aid: array-like of device_aid strings (numpy, pandas or pyarrow)
+    :param seed: int, the same seed always gives the same hash for the same device
+    :return: numpy array of uint64
+    """
+    return pd.util.hash_array(_to_object_array(device_aid), hash_key='%016d' % seed, categorize=True)
+
+
+def device_group(device_aid, num_groups=300, seed=68):
+    """
+    Assign device ids to num_groups groups by hash; no lookup table and no join is needed,
+    so any stage can recompute the group of a device on its own.
+    :param device_aid: array-like of device_aid strings
+    :param num_groups: int, number of groups
+    :param seed: int, hash seed
+    :return: numpy array of int64 group ids in [0, num_groups)
+    """
+    return (device_hash(device_aid, seed=seed) % np.uint64(num_groups)).astype(np.int64)
+
+
+def legacy_table(legacy_file=legacy_grp_file, seed=68):
+    """
+    Stored groups of the devices converted before hash grouping as a compact lookup table: the sorted
+    device_hash of the devices and their groups (10 bytes per device instead of a string index).
+    The table is cached next to legacy_file as .npy files and memory-mapped, so processes that load it
+    share its pages; the first call (e.g., in a parent process) builds the cache.
+    :param legacy_file: parquet file with columns uid and batch (= group)
+    :param seed: int, hash seed
+    :return: uint64 array of sorted hashes, int16 array of groups
+    """
+    stem = os.path.splitext(legacy_file)[0]
+    files = (f'{stem}_hash{seed}.npy', f'{stem}_grp{seed}.npy')
+    if not all(os.path.isfile(f) and os.path.getmtime(f) >= os.path.getmtime(legacy_file) for f in files):
+        print('Building the lookup table of existing groups...')
+        devices = pd.read_parquet(legacy_file, columns=['uid', 'batch'])
+        hashes = device_hash(devices['uid'].values, seed=seed)
+        order = np.argsort(hashes, kind='stable')
+        for f, values in zip(files, (hashes[order], devices['batch'].values[order].astype(np.int16))):
+            tmp_path = os.path.join(os.path.dirname(f), f'.{os.path.basename(f)}.{os.getpid()}.tmp')
+            with open(tmp_path, 'wb') as fh:
+                np.save(fh, values)
+            os.replace(tmp_path, f)
+    return tuple(np.load(f, mmap_mode='r') for f in files)
+
+
+class DeviceGrouper:
+    def __init__(self, num_groups=300, seed=68, legacy=False, legacy_file=legacy_grp_file):
+        """
+        :param num_groups: int, number of groups
+        :param seed: int, hash seed
+        :param legacy: boolean, if true, devices listed in legacy_file keep their stored (random) group
+        and only unseen devices are grouped by hash; this reproduces the layout of the data converted before
+        :param legacy_file: parquet file with columns uid and batch (= group), see legacy_table
+        """
+        self.num_groups = num_groups
+        self.seed = seed
+        self.legacy_hashes = None
+        self.legacy_grp = None
+        if legacy:
+            self.legacy_hashes, self.legacy_grp = legacy_table(legacy_file, seed=seed)
+
+    def assign(self, device_aid):
+        """
+        :param device_aid: array-like of device_aid strings
+        :return: numpy array of int64 group ids, -1 for missing device ids
+        """
+        values = _to_object_array(device_aid)
+        hashes = device_hash(values, seed=self.seed)
+        grp = (hashes % np.uint64(self.num_groups)).astype(np.int64)
+        if self.legacy_hashes is not None and len(self.legacy_hashes):
+            pos = np.searchsorted(self.legacy_hashes, hashes).clip(max=len(self.legacy_hashes) - 1)
+            found = self.legacy_hashes[pos] == hashes
+            grp[found] = self.legacy_grp[pos[found]]
+        grp[pd.isna(values)] = -1
+        return grp
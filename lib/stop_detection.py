@@ -0,0 +1,284 @@
+import itertools
+import numpy as np
+import pandas as pd
+from infostop import Infostop
+
+
+R1, R2, MIN_STAY, MAX_TIME_BETWEEN = 30, 30, 15, 3  # meters, meters, minutes, hours
+stop_point_cols = ['device_aid', 'timestamp', 'latitude', 'longitude', 'loc', 'stop_latitude', 'stop_longitude',
+                   'interval']
+stop_cols = ['device_aid', 'interval', 'loc', 'start', 'end', 'latitude', 'longitude', 'size']
+
+
+def clean_points(data=None):
+    """
+    Points of one device without abnormal coordinates, missing values and duplicated
+    (latitude, longitude, timestamp), sorted by time.
+    :param data: dataframe of latitude, longitude and timestamp (integer seconds)
+    :return: latitude, longitude and timestamp float arrays
+    """
+    lat, lon = data['latitude'].values.astype(np.float64), data['longitude'].values.astype(np.float64)
+    ts = data['timestamp'].values.astype(np.float64)
+    complete = data.notna().all(axis=1).values
+    keep = ~((lat > 84) | (lat < -80) | (lon > 180) | (lon < -180)) & ~np.isnan(ts)
+    lat, lon, ts, complete = lat[keep], lon[keep], ts[keep], complete[keep]
+    # Same order as sort_values(by='timestamp') (the sort is not stable, so it runs on the same rows),
+    # then drop incomplete rows and keep the first of each duplicated point
+    order = np.argsort(ts, kind='quicksort')
+    order = order[complete[order]]
+    lat, lon, ts = lat[order], lon[order], ts[order]
+    pos = np.arange(len(ts))
+    dup_order = np.lexsort((pos, lon, lat, ts))
+    same = (ts[dup_order][1:] == ts[dup_order][:-1]) & (lat[dup_order][1:] == lat[dup_order][:-1]) & \
+           (lon[dup_order][1:] == lon[dup_order][:-1])
+    first = np.ones(len(ts), dtype=bool)
+    first[dup_order[1:][same]] = False
+    return lat[first], lon[first], ts[first]
+
+
+def split_gaps(lat=None, lon=None, ts=None, max_time_between=MAX_TIME_BETWEEN * 60 * 60):
+    """
+    Add a point max_time_between - 1 seconds after each point followed by a gap of at least max_time_between,
+    so that long gaps split stays. Points sharing the timestamp of the next point are dropped.
+    :param lat, lon, ts: arrays of clean_points
+    :param max_time_between: int, seconds
+    :return: dataframe of latitude, longitude and timestamp (float)
+    """
+    # range(ts, min(t_seg, ts + max_time_between), max_time_between - 1) per point,
+    # which is [ts] or [ts, ts + max_time_between - 1], or empty if the next point has the same timestamp
+    start = np.floor(ts)
+    t_seg = np.r_[ts[1:], ts[-1:] + 1]
+    n = np.where(t_seg > start, 1, 0) + (t_seg > start + max_time_between - 1)
+    rows = np.repeat(np.arange(len(ts)), n)
+    offsets = np.arange(len(rows)) - np.repeat(np.cumsum(n) - n, n)
+    return pd.DataFrame(dict(latitude=lat[rows], longitude=lon[rows],
+                             timestamp=start[rows] + offsets * (max_time_between - 1)))
+
+
+def preprocess_points(data=None, max_time_between=MAX_TIME_BETWEEN * 60 * 60):
+    """
+    Points of one device for Infostop: clean_points followed by split_gaps.
+    :param data: dataframe of latitude, longitude and timestamp (integer seconds)
+    :param max_time_between: int, seconds
+    :return: dataframe of latitude, longitude and timestamp (float)
+    """
+    return split_gaps(*clean_points(data), max_time_between=max_time_between)
+
+
+def group_median(values=None, groups=None):
+    """
+    :param values: float array
+    :param groups: int array of group ids 0..k-1, every id present
+    :return: array of the k group medians
+    """
+    order = np.lexsort((values, groups))
+    counts = np.bincount(groups)
+    first = np.cumsum(counts) - counts
+    v = values[order]
+    return (v[first + (counts - 1) // 2] + v[first + counts // 2]) / 2
+
+
+def infostop_labels(x=None, r1=R1, r2=R2, min_stay=MIN_STAY, max_time_between=MAX_TIME_BETWEEN):
+    """
+    Infostop: stationary events within r1, clustered into locations by Infomap on the network of events
+    closer than r2.
+    :param x: preprocessed points (preprocess_points)
+    :return: array of location labels (-1 for moving points), dict of label -> [latitude, longitude]
+    """
+    model = Infostop(
+        r1=r1,
+        r2=r2,
+        label_singleton=True,
+        min_staying_time=min_stay*60,
+        max_time_between=max_time_between*60*60,
+        min_size=2,
+        min_spacial_resolution=0,
+        distance_metric='haversine',
+        weighted=False,
+        weight_exponent=1,
+        verbose=False,)
+    labels = model.fit_predict(x[['latitude', 'longitude', 'timestamp']].values)
+    return labels, model.compute_label_medians()
+
+
+def staypoint_labels(x=None, r1=R1, r2=R2, min_stay=MIN_STAY, max_time_between=MAX_TIME_BETWEEN):
+    """
+    Single-pass staypoint detection: consecutive points stay in the same group while they are within r1 of the
+    group's mean position and less than max_time_between apart; groups of at least two points lasting
+    min_stay or longer are stays. Stays are then merged greedily into locations (largest stays first, a stay
+    joins the nearest location centre within r2). O(n) per device, plus O(k) for k stays.
+    :param x: preprocessed points (preprocess_points)
+    :return: array of location labels (-1 for moving points), dict of label -> [latitude, longitude]
+    """
+    n = len(x)
+    labels = np.full(n, -1, dtype=np.int64)
+    if n == 0:
+        return labels, dict()
+    lat, lon, ts = x['latitude'].values, x['longitude'].values, x['timestamp'].values
+    # Local equirectangular projection in meters
+    earth_radius = 6371008.8
+    py = np.radians(lat) * earth_radius
+    px = np.radians(lon) * earth_radius * np.cos(np.radians(np.median(lat)))
+    r1_sq, min_stay_s, max_gap = r1 ** 2, min_stay * 60, max_time_between * 60 * 60
+    px_l, py_l, ts_l = px.tolist(), py.tolist(), ts.tolist()
+    starts, ends = [], []
+    first, sx, sy, k = 0, px_l[0], py_l[0], 1
+    for j in range(1, n + 1):
+        if j < n and ts_l[j] - ts_l[j - 1] < max_gap and \
+                (px_l[j] - sx / k) ** 2 + (py_l[j] - sy / k) ** 2 <= r1_sq:
+            sx, sy, k = sx + px_l[j], sy + py_l[j], k + 1
+            continue
+        if k >= 2 and ts_l[j - 1] - ts_l[first] >= min_stay_s:
+            starts.append(first)
+            ends.append(j)
+        if j < n:
+            first, sx, sy, k = j, px_l[j], py_l[j], 1
+    if not starts:
+        return labels, dict()
+
+    # Stay centres (medians of their points)
+    starts, ends = np.array(starts), np.array(ends)
+    size = ends - starts
+    stay = np.repeat(np.arange(len(starts)), size)
+    idx = np.arange(len(stay)) - np.repeat(np.cumsum(size) - size, size) + np.repeat(starts, size)
+    stay_lat, stay_lon = group_median(lat[idx], stay), group_median(lon[idx], stay)
+    stay_x, stay_y = group_median(px[idx], stay).tolist(), group_median(py[idx], stay).tolist()
+
+    # Greedy merge of the stays into locations on a grid of r2 cells
+    cells, centre_x, centre_y, stay_loc = dict(), [], [], np.empty(len(starts), dtype=np.int64)
+    for s in np.argsort(-size, kind='stable').tolist():
+        cx, cy = stay_x[s], stay_y[s]
+        gx, gy = int(cx // r2), int(cy // r2)
+        best, best_d = -1, r2 ** 2
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for loc in cells.get((gx + dx, gy + dy), ()):
+                    d = (centre_x[loc] - cx) ** 2 + (centre_y[loc] - cy) ** 2
+                    if d <= best_d:
+                        best, best_d = loc, d
+        if best < 0:
+            best = len(centre_x)
+            centre_x.append(cx)
+            centre_y.append(cy)
+            cells.setdefault((gx, gy), []).append(best)
+        stay_loc[s] = best
+
+    # Labels from 1, locations with more points first; coordinates are the medians of their stay centres
+    points = np.bincount(stay_loc, weights=size, minlength=len(centre_x))
+    rank = np.empty(len(centre_x), dtype=np.int64)
+    rank[np.argsort(-points, kind='stable')] = np.arange(1, len(centre_x) + 1)
+    stay_label = rank[stay_loc]
+    labels[idx] = stay_label[stay]
+    loc_lat, loc_lon = group_median(stay_lat, stay_label - 1), group_median(stay_lon, stay_label - 1)
+    return labels, {k + 1: [loc_lat[k], loc_lon[k]] for k in range(len(loc_lat))}
+
+
+stop_methods = {'infostop': infostop_labels, 'staypoint': staypoint_labels}
+
+
+def label_points(device_aid=None, x=None, labels=None, label_medians=None, max_time_between=MAX_TIME_BETWEEN):
+    """
+    :param x: preprocessed points
+    :param labels: location label of each point (-1 for moving points)
+    :param label_medians: dict of label -> [latitude, longitude]
+    :return: dataframe of stop_point_cols, the points at stop locations (loc > 0)
+    """
+    # A new interval starts at each change of location or gap of max_time_between
+    loc, ts = np.asarray(labels, dtype=np.int64), x['timestamp'].values
+    same_loc = np.r_[False, loc[1:] == loc[:-1]]
+    little_time = np.r_[False, np.diff(ts) < max_time_between*60*60]
+    interval = np.cumsum(~(same_loc & little_time))
+
+    # keep only stop locations
+    keep = loc > 0
+    medians = pd.DataFrame.from_dict(label_medians, orient='index', columns=['lat', 'lon']).reindex(loc[keep])
+    return pd.DataFrame(dict(device_aid=device_aid, timestamp=ts[keep], latitude=x['latitude'].values[keep],
+                             longitude=x['longitude'].values[keep], loc=loc[keep],
+                             stop_latitude=medians['lat'].values, stop_longitude=medians['lon'].values,
+                             interval=interval[keep]), columns=stop_point_cols)
+
+
+def detect_stops(device_aid=None, data=None, r1=R1, r2=R2, min_stay=MIN_STAY, max_time_between=MAX_TIME_BETWEEN,
+                 method='infostop'):
+    """
+    Stop detection of one device.
+    :param device_aid: str, device id
+    :param data: dataframe of the device's latitude, longitude and timestamp
+    :param r1: meters, max roaming distance of a stay
+    :param r2: meters, max distance between stays of the same location
+    :param min_stay: minutes, min duration of a stay
+    :param max_time_between: hours, max time between consecutive points of a stay
+    :param method: 'infostop' (infostop_labels) or 'staypoint' (staypoint_labels, linear time)
+    :return: dataframe of stop_point_cols, the points at stop locations (loc > 0)
+    """
+    if method not in stop_methods:
+        raise ValueError(f'Unknown stop detection method: {method}')
+    # Remove abnormal and low-precision GPS records, deduplicate and split long gaps
+    x = preprocess_points(data, max_time_between=max_time_between*60*60)
+
+    try:
+        labels, label_medians = stop_methods[method](x, r1=r1, r2=r2, min_stay=min_stay,
+                                                     max_time_between=max_time_between)
+    except:
+        return pd.DataFrame([], columns=stop_point_cols)
+    return label_points(device_aid, x, labels, label_medians, max_time_between=max_time_between)
+
+
+def param_key(r1=R1, r2=R2, min_stay=MIN_STAY, max_time_between=MAX_TIME_BETWEEN):
+    """
+    :return: str, name of a parameter setting, e.g., 'r1_30_r2_30_min_stay_15_mtb_3'
+    """
+    return f'r1_{r1:g}_r2_{r2:g}_min_stay_{min_stay:g}_mtb_{max_time_between:g}'
+
+
+def param_grid(r1=(R1,), r2=(R2,), min_stay=(MIN_STAY,), max_time_between=(MAX_TIME_BETWEEN,)):
+    """
+    All combinations of the given parameter values.
+    :return: dict of param_key -> dict of detect_stops parameters
+    """
+    grid = dict()
+    for values in itertools.product(r1, r2, min_stay, max_time_between):
+        params = dict(zip(['r1', 'r2', 'min_stay', 'max_time_between'], values))
+        grid[param_key(**params)] = params
+    return grid
+
+
+def sweep_stops(device_aid=None, data=None, grid=None, method='infostop'):
+    """
+    Stop detection of one device under several parameter settings. The points are cleaned once and split
+    at gaps once per max_time_between, so each setting only adds the clustering.
+    :param grid: dict of key -> dict of detect_stops parameters (param_grid)
+    :return: dict of key -> dataframe of stop_point_cols
+    """
+    if method not in stop_methods:
+        raise ValueError(f'Unknown stop detection method: {method}')
+    lat, lon, ts = clean_points(data)
+    split, out = dict(), dict()
+    for key, params in grid.items():
+        params = dict(dict(r1=R1, r2=R2, min_stay=MIN_STAY, max_time_between=MAX_TIME_BETWEEN), **params)
+        mtb = params['max_time_between']
+        if mtb not in split:
+            split[mtb] = split_gaps(lat, lon, ts, max_time_between=mtb*60*60)
+        try:
+            labels, label_medians = stop_methods[method](split[mtb], **params)
+        except:
+            out[key] = pd.DataFrame([], columns=stop_point_cols)
+            continue
+        out[key] = label_points(device_aid, split[mtb], labels, label_medians, max_time_between=mtb)
+    return out
+
+
+def stop_intervals(points=None):
+    """
+    One row per stay (device_aid, interval) of the stop points, as the Spark aggregation of 5-stop-detection.py.
+    :param points: dataframe of stop_point_cols
+    :return: dataframe of stop_cols, start and end as int32 seconds
+    """
+    stops = points.groupby(['device_aid', 'interval'], sort=False).agg(loc=('loc', 'first'),
+                                                                       start=('timestamp', 'min'),
+                                                                       end=('timestamp', 'max'),
+                                                                       latitude=('stop_latitude', 'first'),
+                                                                       longitude=('stop_longitude', 'first'),
+                                                                       size=('loc', 'count')).reset_index()
+    return stops.astype(dict(interval=np.int32, loc=np.int32, start=np.int32, end=np.int32,
+                             latitude=np.float64, longitude=np.float64, size=np.int64))[stop_cols]
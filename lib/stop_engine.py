@@ -0,0 +1,477 @@
+import os
+import time
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import partitioner
+import mad_store
+import stop_detection
+
+
+ROOT_dir = Path(__file__).parent.parent
+stops_folder = os.path.join(ROOT_dir, 'dbs/stops_combined')
+point_cols = ['device_aid', 'timestamp', 'latitude', 'longitude']
+state_cols = ['batch', 'period', 'start', 'end', 'window_days', 'stops', 'finished']
+timing_cols = ['device_aid', 'points', 'seconds']
+
+
+def to_ipc(table=None):
+    """
+    Serialize a (sliced) table; only the rows of the slice are written.
+    """
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
+
+
+def detect_chunk(buffer=None, params=None):
+    """
+    Stop detection of the devices of one chunk, run in a worker process.
+    :param buffer: IPC stream of point_cols, sorted by device_aid and timestamp
+    :param params: dict of stop_detection.detect_stops parameters
+    :return: dataframe of stop_detection.stop_cols, dataframe of timing_cols
+    """
+    df = pa.ipc.open_stream(buffer).read_all().to_pandas()
+    points, timing = [], []
+    for device_aid, data in df.groupby('device_aid', sort=False):
+        t = time.perf_counter()
+        points.append(stop_detection.detect_stops(device_aid, data, **(params or {})))
+        timing.append((device_aid, len(data), time.perf_counter() - t))
+    timing = pd.DataFrame(timing, columns=timing_cols)
+    points = [p for p in points if len(p) > 0]
+    if not points:
+        return pd.DataFrame([], columns=stop_detection.stop_cols), timing
+    return stop_detection.stop_intervals(pd.concat(points, ignore_index=True)), timing
+
+
+def sweep_chunk(buffer=None, grid=None, method='infostop'):
+    """
+    Stop detection of the devices of one chunk under each parameter setting of grid, run in a worker process.
+    :param buffer: IPC stream of point_cols, sorted by device_aid and timestamp
+    :param grid: dict of key -> dict of stop_detection.detect_stops parameters (stop_detection.param_grid)
+    :param method: stop detection method
+    :return: dict of key -> dataframe of stop_detection.stop_cols, dataframe of timing_cols (all settings)
+    """
+    df = pa.ipc.open_stream(buffer).read_all().to_pandas()
+    points, timing = {key: [] for key in grid}, []
+    for device_aid, data in df.groupby('device_aid', sort=False):
+        t = time.perf_counter()
+        for key, p in stop_detection.sweep_stops(device_aid, data, grid=grid, method=method).items():
+            if len(p) > 0:
+                points[key].append(p)
+        timing.append((device_aid, len(data), time.perf_counter() - t))
+    return {key: stop_detection.stop_intervals(pd.concat(p, ignore_index=True)) if p else
+            pd.DataFrame([], columns=stop_detection.stop_cols) for key, p in points.items()}, \
+        pd.DataFrame(timing, columns=timing_cols)
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371008.8 * np.arcsin(np.sqrt(a))
+
+
+def merge_stops(old=None, new=None, merge_time=None, r2=stop_detection.R2):
+    """
+    Combine the stops of a previous run (old) with the stops detected on a window of data starting before the
+    previous run's last day (new). Old stays ending before merge_time are kept, and new stays ending at or
+    after it, unless they start before the last kept old stay of the device ends. Location and interval ids of
+    the new stays continue those of the device: a new location within r2 meters of an existing location gets
+    its id and coordinates, other locations get ids after the largest existing one.
+    :param old: dataframe of stop_detection.stop_cols
+    :param new: dataframe of stop_detection.stop_cols
+    :param merge_time: int, seconds, inside the window and at least max_time_between after its start
+    :param r2: meters
+    :return: dataframe of stop_detection.stop_cols sorted by device_aid and interval
+    """
+    old = old.loc[old['end'] < merge_time, stop_detection.stop_cols]
+    new = new.loc[new['end'] >= merge_time, stop_detection.stop_cols]
+    old_end = old.groupby('device_aid')['end'].max()
+    new = new.loc[new['start'].values > new['device_aid'].map(old_end).fillna(-np.inf).values]
+
+    old_locs = old.groupby(['device_aid', 'loc'], as_index=False)[['latitude', 'longitude']].first()
+    new_locs = new.groupby(['device_aid', 'loc'], as_index=False)[['latitude', 'longitude']].first()
+    pairs = new_locs.merge(old_locs, on='device_aid', suffixes=('', '_old'))
+    pairs['d'] = haversine_m(pairs['latitude'], pairs['longitude'], pairs['latitude_old'], pairs['longitude_old'])
+    pairs = pairs.loc[pairs['d'] <= r2].sort_values(['device_aid', 'loc', 'd']).drop_duplicates(['device_aid', 'loc'])
+    new_locs = new_locs.merge(pairs[['device_aid', 'loc', 'loc_old', 'latitude_old', 'longitude_old']],
+                              on=['device_aid', 'loc'], how='left')
+    unmatched = new_locs['loc_old'].isna().values
+    base = new_locs['device_aid'].map(old.groupby('device_aid')['loc'].max()).fillna(0).values
+    rank = pd.Series(unmatched).groupby(new_locs['device_aid'].values).cumsum().values
+    new_locs['loc_old'] = np.where(unmatched, base + rank, new_locs['loc_old'].values)
+    for col in ('latitude', 'longitude'):
+        new_locs[f'{col}_old'] = np.where(unmatched, new_locs[col].values, new_locs[f'{col}_old'].values)
+
+    new = new.drop(columns=['latitude', 'longitude']).merge(new_locs.drop(columns=['latitude', 'longitude']),
+                                                            on=['device_aid', 'loc'], how='left')
+    new = new.drop(columns='loc').rename(columns={'loc_old': 'loc', 'latitude_old': 'latitude',
+                                                  'longitude_old': 'longitude'})
+    new = new.sort_values(['device_aid', 'start'])
+    new['interval'] = new['device_aid'].map(old.groupby('device_aid')['interval'].max()).fillna(0).values + \
+        new.groupby('device_aid').cumcount().values + 1
+    stops = pd.concat([old, new[stop_detection.stop_cols]], ignore_index=True)
+    return stops.astype(dict(interval=np.int32, loc=np.int32, start=np.int32, end=np.int32,
+                             latitude=np.float64, longitude=np.float64, size=np.int64)).\
+        sort_values(['device_aid', 'interval']).reset_index(drop=True)
+
+
+def stitch(results=None, r2=stop_detection.R2):
+    """
+    Stops of the chunks of a batch, with the time windows of split devices merged back together (merge_stops).
+    :param results: list of (dataframe of stop_detection.stop_cols, piece) where piece is None for a chunk of
+    whole devices, or (device_aid, index, merge time) for a window of a split device (StopEngine.windows)
+    :param r2: meters
+    :return: list of dataframes of stop_detection.stop_cols
+    """
+    out = [stops for stops, piece in results if piece is None]
+    pieces = sorted([(piece, stops) for stops, piece in results if piece is not None], key=lambda x: x[0][:2])
+    for device_aid in dict.fromkeys(piece[0] for piece, _ in pieces):
+        windows = [(piece, stops) for piece, stops in pieces if piece[0] == device_aid]
+        stops = windows[0][1]
+        for (_, _, merge_time), new in windows[1:]:
+            stops = merge_stops(old=stops, new=new, merge_time=merge_time, r2=r2)
+        out.append(stops)
+    return out
+
+
+class StopEngine:
+    def __init__(self, reader=None, dictionary=None, folder=stops_folder, workers=18, num_buckets=16,
+                 devices_per_task=500, task_points=200000, max_device_points=1000000, overlap_hours=12,
+                 temp_directory=None, params=None):
+        """
+        Stop detection without Spark: the records of a batch are streamed once from the store and spilled
+        into num_buckets device buckets (Arrow IPC files); each bucket is sorted by device and time, cut into
+        chunks of whole devices and sent to a process pool, where stop detection and the aggregation into
+        stays run. Memory is bounded by one bucket plus 2 * workers chunks in flight.
+        Chunks are packed by their number of records, the estimated cost, and the most expensive ones are
+        submitted first. A device with more than max_device_points records is split into time windows (see
+        windows), whose stops are merged back with merge_stops.
+        The per-device runtimes are written to folder/_timing/timing_{batch}.parquet.
+        A batch is written as folder/stops_{batch}.parquet (renamed when complete), batches with an existing
+        file are skipped, so an interrupted run resumes with the next unfinished batch.
+        New deliveries are added with run_incremental, which only reads the new days and a boundary window.
+        :param reader: mad_store.StoreReader of the converted data
+        :param dictionary: device_dict.DeviceDictionary, adds the device_id column
+        :param folder: output folder
+        :param workers: int, worker processes
+        :param num_buckets: int, device buckets per batch
+        :param devices_per_task: int, max devices per chunk
+        :param task_points: int, max records per chunk of whole devices
+        :param max_device_points: int, records of a device above which it is split into windows
+        :param overlap_hours: int, records before the seam added to a window when no gap of max_time_between
+        is found near the cut, at least 2 * max_time_between; stays longer than half of it may be cut at the seam
+        :param temp_directory: str, spill folder, None for the system temp folder
+        :param params: dict of stop_detection.detect_stops parameters, None for the defaults
+        """
+        self.reader = reader
+        self.dictionary = dictionary
+        self.folder = folder
+        self.workers = workers
+        self.num_buckets = num_buckets
+        self.devices_per_task = devices_per_task
+        self.task_points = task_points
+        self.max_device_points = max_device_points
+        self.overlap = overlap_hours * 60 * 60
+        self.temp_directory = temp_directory
+        self.params = params
+
+    def stops_file(self, batch=None):
+        return os.path.join(self.folder, f'stops_{batch}.parquet')
+
+    def timing_file(self, batch=None):
+        return os.path.join(self.folder, '_timing', f'timing_{batch}.parquet')
+
+    def sweep_file(self, key=None, batch=None):
+        return os.path.join(self.folder, 'sweep', key, f'stops_{batch}.parquet')
+
+    def state_file(self):
+        return os.path.join(self.folder, '_state', 'progress.parquet')
+
+    def read_state(self):
+        """
+        :return: dataframe of state_cols, one row per finished (batch, period) of run_incremental
+        """
+        if os.path.isfile(self.state_file()):
+            return pd.read_parquet(self.state_file())
+        return pd.DataFrame([], columns=state_cols)
+
+    def mark_done(self, batch=None, period=None, start=None, end=None, window_days=None, stops=None):
+        state = self.read_state()
+        state = state.loc[~((state['batch'] == batch) & (state['period'] == period))]
+        row = pd.DataFrame([dict(batch=batch, period=period, start=str(start), end=str(end),
+                                 window_days=window_days, stops=stops, finished=pd.Timestamp.now())])
+        state = pd.concat([state, row], ignore_index=True) if len(state) else row
+        os.makedirs(os.path.dirname(self.state_file()), exist_ok=True)
+        tmp_path = mad_store.temp_file(self.state_file())
+        state.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, self.state_file())
+
+    def spill(self, batch=None, spill_dir=None, start=None, end=None, filter=None):
+        """
+        Stream the records of a batch into device buckets.
+        :param start: first day, None for all
+        :param end: last day, None for all
+        :param filter: pyarrow.dataset expression on the records
+        :return: list of bucket files
+        """
+        schema = pa.schema([('device_aid', pa.string()), ('timestamp', pa.int64()),
+                            ('latitude', pa.float64()), ('longitude', pa.float64())])
+        writers = dict()
+        for record_batch in self.reader.iter_batches(groups=[batch], start=start, end=end, columns=point_cols,
+                                                     filter=filter):
+            table = pa.Table.from_batches([record_batch]).select(point_cols).cast(schema)
+            bucket = partitioner.device_group(table.column('device_aid'), num_groups=self.num_buckets, seed=7)
+            for b, part in mad_store.split_by_group(table, bucket):
+                if b not in writers:
+                    writers[b] = pa.ipc.new_file(os.path.join(spill_dir, f'bucket_{b}.arrow'), schema)
+                writers[b].write_table(part)
+        for writer in writers.values():
+            writer.close()
+        return [os.path.join(spill_dir, f'bucket_{b}.arrow') for b in sorted(writers)]
+
+    def windows(self, timestamp=None, max_gap=None):
+        """
+        Time windows of about max_device_points records of one device. Each seam is placed at the largest time
+        gap among the last quarter of the records before the cut: a gap of at least 2 * max_gap splits stays
+        (stop_detection.split_gaps bridges shorter ones), so the windows meet there and are merged at the seam;
+        otherwise the window starts overlap seconds before the
+        seam and they are merged at the middle of the overlap. A window ends one record after the next seam.
+        :param timestamp: sorted timestamps (seconds) of the device
+        :param max_gap: int, seconds, max_time_between of stop detection
+        :return: list of (first row, end row, merge time), merge time None for the first window
+        """
+        n = len(timestamp)
+        firsts, seams, merge_times = [0], [0], [None]
+        cut = self.max_device_points
+        while cut < n:
+            search = max(seams[-1] + 1, cut - self.max_device_points // 4)
+            gaps = timestamp[search:cut + 1] - timestamp[search - 1:cut]
+            seam = search + int(np.argmax(gaps))
+            if timestamp[seam] - timestamp[seam - 1] >= 2 * max_gap:
+                firsts.append(seam)
+                merge_times.append(int(timestamp[seam]))
+            else:
+                seam = cut
+                firsts.append(int(np.searchsorted(timestamp, timestamp[seam] - self.overlap)))
+                merge_times.append(int(timestamp[seam] - self.overlap // 2))
+            seams.append(seam)
+            cut = seam + self.max_device_points
+        ends = [min(seam + 1, n) for seam in seams[1:]] + [n]
+        return list(zip(firsts, ends, merge_times))
+
+    def plan(self, device=None, timestamp=None, max_time_between=stop_detection.MAX_TIME_BETWEEN):
+        """
+        Tasks of the records of a bucket sorted by device and time: chunks of whole devices with at most
+        devices_per_task devices and task_points records (a device may exceed it), and time windows of the
+        devices with more than max_device_points records (see windows).
+        :param max_time_between: hours, max_time_between of stop detection
+        :return: list of (first row, end row, piece) sorted by number of rows, largest first; piece is None for
+        whole devices, or (device_aid, index, merge time) for a window (see stitch)
+        """
+        starts = np.flatnonzero(np.r_[True, device[1:] != device[:-1]])
+        ends = np.r_[starts[1:], len(device)]
+        tasks, first, n_devices = [], None, 0
+        for a, b in zip(starts.tolist(), ends.tolist()):
+            heavy = b - a > self.max_device_points
+            if first is not None and (heavy or n_devices >= self.devices_per_task or b - first > self.task_points):
+                tasks.append((first, a, None))
+                first, n_devices = None, 0
+            if heavy:
+                for k, (lo, hi, merge_time) in enumerate(self.windows(timestamp[a:b], max_time_between * 60 * 60)):
+                    tasks.append((a + lo, a + hi, (device[a], k, merge_time)))
+                continue
+            first = a if first is None else first
+            n_devices += 1
+        if first is not None:
+            tasks.append((first, len(device), None))
+        return sorted(tasks, key=lambda x: x[0] - x[1])
+
+    def chunks(self, bucket_file=None, max_time_between=stop_detection.MAX_TIME_BETWEEN):
+        """
+        :return: generator of IPC buffers of the tasks of a bucket (see plan) and their piece
+        """
+        with pa.memory_map(bucket_file) as source:
+            table = mad_store.sort_devices(pa.ipc.open_file(source).read_all())
+        device = table.column('device_aid').to_numpy(zero_copy_only=False)
+        timestamp = table.column('timestamp').to_numpy()
+        for a, b, piece in self.plan(device, timestamp, max_time_between=max_time_between):
+            yield to_ipc(table.slice(a, b - a)), piece
+
+    def map_chunks(self, batch=None, pool=None, func=None, args=(), start=None, end=None, filter=None,
+                   max_time_between=stop_detection.MAX_TIME_BETWEEN):
+        """
+        :return: list of (func(chunk, *args), piece) over the chunks of the records of a batch (see spill)
+        """
+        results, pending = [], dict()
+        spill_dir = tempfile.mkdtemp(prefix=f'stops_{batch}_', dir=self.temp_directory)
+        try:
+            for bucket_file in self.spill(batch=batch, spill_dir=spill_dir, start=start, end=end, filter=filter):
+                for buffer, piece in self.chunks(bucket_file, max_time_between=max_time_between):
+                    if len(pending) >= 2 * self.workers:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        results += [(f.result(), pending.pop(f)) for f in done]
+                    pending[pool.submit(func, buffer, *args)] = piece
+                os.remove(bucket_file)
+            results += [(f.result(), piece) for f, piece in pending.items()]
+        finally:
+            shutil.rmtree(spill_dir, ignore_errors=True)
+        return results
+
+    @staticmethod
+    def combine(results=None):
+        results = [r for r in results if len(r) > 0]
+        if results:
+            return pd.concat(results, ignore_index=True).sort_values(['device_aid', 'interval'])
+        return stop_detection.stop_intervals(pd.DataFrame([], columns=stop_detection.stop_point_cols))
+
+    def save_timing(self, results=None, batch=None):
+        """
+        Write the per-device runtimes of a batch (timing_cols, plus the window index of split devices)
+        and print the slowest devices.
+        :param results: list of ((stops, timing), piece) of map_chunks
+        """
+        timing = pd.concat([r[1].assign(window=-1 if piece is None else piece[1]) for r, piece in results],
+                           ignore_index=True)
+        timing['batch'] = batch
+        os.makedirs(os.path.dirname(self.timing_file(batch)), exist_ok=True)
+        tmp_path = mad_store.temp_file(self.timing_file(batch))
+        timing.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, self.timing_file(batch))
+        devices = timing.groupby('device_aid')[['points', 'seconds']].sum().sort_values('seconds', ascending=False)
+        top = devices.head(5)
+        print(f"{len(devices)} devices in {devices['seconds'].sum():.0f} s of worker time, "
+              f"{top['seconds'].sum() / max(devices['seconds'].sum(), 1e-9):.0%} in the slowest 5:")
+        print(top.to_string(float_format='%.1f'))
+
+    def detect_batch(self, batch=None, pool=None, start=None, end=None, filter=None):
+        """
+        :return: dataframe of stop_detection.stop_cols of the records of a batch (see spill)
+        """
+        params = self.params or {}
+        results = self.map_chunks(batch=batch, pool=pool, func=detect_chunk, args=(self.params,),
+                                  start=start, end=end, filter=filter,
+                                  max_time_between=params.get('max_time_between', stop_detection.MAX_TIME_BETWEEN))
+        if results:
+            self.save_timing(results, batch=batch)
+        return self.combine(stitch([(r[0], piece) for r, piece in results],
+                                   r2=params.get('r2', stop_detection.R2)))
+
+    def save_stops(self, df_stops=None, batch=None, file_path=None):
+        file_path = file_path or self.stops_file(batch)
+        df_stops['batch'] = batch
+        if self.dictionary is not None:
+            df_stops['device_id'] = self.dictionary.encode(df_stops['device_aid'], add=True)
+            self.dictionary.save()
+        print("Saving data...")
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        tmp_path = mad_store.temp_file(file_path)
+        df_stops.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, file_path)
+
+    def stop_batch(self, batch=None, pool=None):
+        print(f'Processing user group {batch}:')
+        start = time.time()
+        self.save_stops(self.detect_batch(batch=batch, pool=pool), batch=batch)
+        print(f"Group {batch} processed and saved in {(time.time() - start) // 60} minutes.")
+
+    def stop_batch_incremental(self, batch=None, pool=None, start=None, end=None, window_days=2):
+        """
+        Detect stops on the days start - end plus window_days before start, and merge them into the
+        existing stops of the batch at the middle of the window (merge_stops).
+        :return: int, number of stops of the batch
+        """
+        print(f'Processing user group {batch} ({start} - {end}):')
+        t = time.time()
+        seam = int(pd.Timestamp(start).timestamp())
+        window_start = seam - window_days * 86400
+        # Day partitions may not follow UTC days, so one more day is listed and the records are cut by time
+        new = self.detect_batch(batch=batch, pool=pool,
+                                start=pd.Timestamp(window_start, unit='s').date() - pd.Timedelta(days=1), end=end,
+                                filter=ds.field('timestamp') >= window_start)
+        if os.path.isfile(self.stops_file(batch)):
+            old = pd.read_parquet(self.stops_file(batch), columns=stop_detection.stop_cols)
+        else:
+            old = new.iloc[:0]
+        df_stops = merge_stops(old=old, new=new, merge_time=seam - window_days * 86400 // 2)
+        self.save_stops(df_stops, batch=batch)
+        print(f"Group {batch} updated in {(time.time() - t) // 60} minutes.")
+        return len(df_stops)
+
+    def run(self, batches=None, overwrite=False):
+        """
+        :param batches: iterable of device groups
+        :param overwrite: boolean, if true, batches with a stops file are processed again
+        """
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            for batch in batches:
+                if not overwrite and os.path.isfile(self.stops_file(batch)):
+                    print(f'Group {batch} done, skipped.')
+                    continue
+                self.stop_batch(batch=batch, pool=pool)
+
+    def run_incremental(self, batches=None, start=None, end=None, period=None, window_days=2, overwrite=False):
+        """
+        Add a newly delivered period to the stops of each batch; finished (batch, period) pairs are
+        recorded in the state file and skipped when the run is repeated.
+        :param batches: iterable of device groups
+        :param start: first new day, e.g., '2023-02-01'
+        :param end: last new day
+        :param period: str, name of the period in the state file, None for 'start_end'
+        :param window_days: int, days before start that are processed again, so that stays crossing
+        the seam are merged; must cover the longest stay expected across it
+        :param overwrite: boolean, if true, finished batches are processed again
+        """
+        period = period or f'{start}_{end}'
+        state = self.read_state()
+        done = set(state.loc[state['period'] == period, 'batch'])
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            for batch in batches:
+                if not overwrite and batch in done:
+                    print(f'Group {batch} ({period}) done, skipped.')
+                    continue
+                stops = self.stop_batch_incremental(batch=batch, pool=pool, start=start, end=end,
+                                                    window_days=window_days)
+                self.mark_done(batch=batch, period=period, start=start, end=end, window_days=window_days,
+                               stops=stops)
+
+    def sweep(self, batches=None, grid=None, method='infostop', overwrite=False):
+        """
+        Stops of each batch under several parameter settings, e.g., for robustness checks: the records are read
+        and cleaned once per device (stop_detection.sweep_stops) and clustered once per setting.
+        The stops of a setting are written as folder/sweep/key/stops_{batch}.parquet with a params column of the key;
+        settings with an existing file are skipped.
+        :param batches: iterable of device groups
+        :param grid: dict of key -> dict of stop_detection.detect_stops parameters (stop_detection.param_grid)
+        :param method: stop detection method
+        :param overwrite: boolean, if true, finished settings are processed again
+        """
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            for batch in batches:
+                todo = {key: params for key, params in grid.items()
+                        if overwrite or not os.path.isfile(self.sweep_file(key, batch))}
+                if not todo:
+                    print(f'Group {batch} done for all {len(grid)} settings, skipped.')
+                    continue
+                print(f'Processing user group {batch} ({len(todo)} settings):')
+                t = time.time()
+                # Seams at gaps of the largest max_time_between split the stays of every setting
+                max_time_between = max(p.get('max_time_between', stop_detection.MAX_TIME_BETWEEN)
+                                       for p in todo.values())
+                results = self.map_chunks(batch=batch, pool=pool, func=sweep_chunk, args=(todo, method),
+                                          max_time_between=max_time_between)
+                if results:
+                    self.save_timing(results, batch=batch)
+                for key, params in todo.items():
+                    df_stops = self.combine(stitch([(r[0][key], piece) for r, piece in results],
+                                                   r2=params.get('r2', stop_detection.R2)))
+                    df_stops['params'] = key
+                    self.save_stops(df_stops, batch=batch, file_path=self.sweep_file(key, batch))
+                print(f"Group {batch} processed and saved in {(time.time() - t) // 60} minutes.")
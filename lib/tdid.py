@@ -12,6 +12,7 @@ import matplotlib.pyplot as plt
 from tqdm import tqdm
 import warnings
 warnings.filterwarnings("ignore")
+import calendar_dim
 
 
 ROOT_dir = Path(__file__).parent.parent
@@ -41,7 +42,7 @@ def data_preparation(data=None, year_list=[2019, 2022], treatment_yr=2022, grp=N
     df['state_weekday'] = df['state'].astype(str) + '_' + df['weekday'].astype(str)
 
     # Time handling
-    df['time'] = pd.to_datetime(df['date'])
+    df['time'] = calendar_dim.parse_dates(df['date'])
     df['dow'] = df['weekday'].astype(int)
 
     # Treatment
@@ -86,7 +87,7 @@ def data_prep_placebo(data=None, treatment_month=4, policy_t='20230401',
     df['state_month'] = df['state'].astype(str) + '_' + df['month'].astype(str)
     df['state_year'] = df['state'].astype(str) + '_' + df['year'].astype(str)
     # Time handling
-    df['time'] = pd.to_datetime(df['date'])
+    df['time'] = calendar_dim.parse_dates(df['date'])
     df['dow'] = df['weekday'].astype(int)
     for var in (f'{unit}_id', 'year', 'month', 'weekday', 'state_month',
                 'state', 'state_year', 'state_holiday'):
@@ -96,7 +97,7 @@ def data_prep_placebo(data=None, treatment_month=4, policy_t='20230401',
     df['post'] = df['year'] == treatment_yr
     df['rain'] = df['precipitation'] # df['precipitation'] > 0
 
-    df.loc[:, 'date_time'] = pd.to_datetime(df['date'].astype(str), format='%Y-%m-%d')
+    df.loc[:, 'date_time'] = calendar_dim.parse_dates(df['date'])
     x = np.datetime64(pd.to_datetime(policy_t, format='%Y%m%d'))
     df['9et'] = df['date_time'] >= x
 
@@ -297,7 +298,7 @@ def perform_stratified_permutation(df=None, treatment_col='9et', post_col='post'
                                    dependent_col=None, cluster_col='state', weights_col=None):
     df_shuffled = df.copy()
     if cluster_col == 'Time':
-        df_shuffled['time'] = pd.to_datetime(df_shuffled['date'])
+        df_shuffled['time'] = calendar_dim.parse_dates(df_shuffled['date'])
         df_shuffled['Time'] = df_shuffled['time'].dt.dayofyear
     # Shuffle treatment within each cluster
     np.random.seed(random_seed)  # Ensure randomness in each permutation
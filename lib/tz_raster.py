@@ -0,0 +1,137 @@
+import os
+import numpy as np
+from pathlib import Path
+from tqdm import tqdm
+from timezonefinder import TimezoneFinder
+import mad_store
+
+
+ROOT_dir = Path(__file__).parent.parent
+raster_folder = os.path.join(ROOT_dir, 'dbs/timezone')
+europe_box = (-25.0, 34.0, 45.0, 72.0)   # lon_min, lat_min, lon_max, lat_max
+ambiguous = np.iinfo(np.uint16).max
+_finder = None
+
+
+def timezone_at(longitude, latitude):
+    """
+    Exact time zone of one point, with one TimezoneFinder per process.
+    """
+    global _finder
+    if _finder is None:
+        _finder = TimezoneFinder()
+    try:
+        return _finder.timezone_at(lng=longitude, lat=latitude)
+    except ValueError:
+        return None
+
+
+class TimezoneRaster:
+    def __init__(self, resolution=0.01, bbox=europe_box, folder=raster_folder):
+        """
+        Time zone lookup on a regular lon/lat grid. A cell stores the time zone of its four corners if they agree;
+        cells crossing a border, and points outside bbox, are resolved exactly with TimezoneFinder.
+        Time zones that do not touch any grid corner (areas smaller than a cell) are not resolved.
+        :param resolution: float, cell size in degrees
+        :param bbox: (lon_min, lat_min, lon_max, lat_max) covered by the raster
+        :param folder: folder of the persisted raster
+        """
+        self.resolution = resolution
+        self.bbox = bbox
+        self.file = os.path.join(folder, f'tz_raster_{resolution}_{"_".join(str(x) for x in bbox)}.npz')
+        self.n_lon = int(round((bbox[2] - bbox[0]) / resolution))
+        self.n_lat = int(round((bbox[3] - bbox[1]) / resolution))
+        self.names = None   # code -> time zone name, code 0 is None (unknown)
+        self.cells = None   # (n_lat, n_lon) uint16 codes, ambiguous for border cells
+
+    def build(self):
+        print(f'Building time zone raster ({self.n_lat} x {self.n_lon} cells)...')
+        lons = self.bbox[0] + np.arange(self.n_lon + 1) * self.resolution
+        lats = self.bbox[1] + np.arange(self.n_lat + 1) * self.resolution
+        names = {None: 0}
+        corners = np.empty((len(lats), len(lons)), dtype=np.uint16)
+        for i, lat in enumerate(tqdm(lats)):
+            corners[i, :] = [names.setdefault(timezone_at(lon, lat), len(names)) for lon in lons]
+        same = (corners[:-1, :-1] == corners[1:, :-1]) & (corners[:-1, :-1] == corners[:-1, 1:]) & \
+               (corners[:-1, :-1] == corners[1:, 1:])
+        self.cells = np.where(same, corners[:-1, :-1], ambiguous).astype(np.uint16)
+        self.names = np.array(sorted(names, key=names.get), dtype=object)
+        print('Share of border cells: %.2f %%' % ((~same).sum() / same.size * 100))
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.file), exist_ok=True)
+        tmp_path = mad_store.temp_file(self.file)
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, cells=self.cells,
+                                names=np.array(['' if x is None else x for x in self.names]))
+        os.replace(tmp_path, self.file)
+
+    def read(self):
+        data = np.load(self.file)
+        self.cells = data['cells']
+        self.names = np.array([None if x == '' else x for x in data['names']], dtype=object)
+
+    def load(self, timeout=6 * 3600):
+        """
+        Load the persisted raster, or build and save it on first use. The build (one TimezoneFinder call per
+        grid corner) takes long; run `python lib/tz_raster.py` once before starting parallel workers. Should
+        several processes still get here first, one builds under a lock and the others wait for its file.
+        :param timeout: seconds to wait for another process building the raster
+        """
+        if not os.path.isfile(self.file):
+            os.makedirs(os.path.dirname(self.file), exist_ok=True)
+            with mad_store.file_lock(self.file, timeout=timeout):
+                if not os.path.isfile(self.file):
+                    self.build()
+                    self.save()
+        self.read()
+        return self
+
+    def lookup(self, longitude, latitude):
+        """
+        :param longitude: array of longitudes
+        :param latitude: array of latitudes
+        :return: numpy array of time zone names, None where unknown
+        """
+        if self.cells is None:
+            self.load()
+        longitude, latitude = np.asarray(longitude, dtype=float), np.asarray(latitude, dtype=float)
+        out = np.full(len(longitude), None, dtype=object)
+        with np.errstate(invalid='ignore'):
+            j = np.floor((longitude - self.bbox[0]) / self.resolution)
+            i = np.floor((latitude - self.bbox[1]) / self.resolution)
+            inside = (i >= 0) & (i < self.n_lat) & (j >= 0) & (j < self.n_lon)
+        codes = np.full(len(longitude), ambiguous, dtype=np.uint16)
+        codes[inside] = self.cells[i[inside].astype(np.int64), j[inside].astype(np.int64)]
+        resolved = codes != ambiguous
+        out[resolved] = self.names[codes[resolved]]
+        # Exact fallback, once per distinct coordinate
+        exact = ~resolved & np.isfinite(longitude) & np.isfinite(latitude)
+        if exact.any():
+            points, inverse = np.unique(np.column_stack([longitude[exact], latitude[exact]]), axis=0,
+                                        return_inverse=True)
+            tz = np.array([timezone_at(lon, lat) for lon, lat in points], dtype=object)
+            out[exact] = tz[inverse.ravel()]
+        return out
+
+
+_raster = None
+
+
+def get_raster(resolution=0.01, bbox=europe_box):
+    """
+    Time zone raster loaded once per process.
+    """
+    global _raster
+    if _raster is None or _raster.resolution != resolution or _raster.bbox != bbox:
+        _raster = TimezoneRaster(resolution=resolution, bbox=bbox).load()
+    return _raster
+
+
+def timezone_lookup(longitude, latitude):
+    return get_raster().lookup(longitude, latitude)
+
+
+if __name__ == '__main__':
+    # Setup step: build and persist the default raster
+    get_raster()
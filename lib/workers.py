@@ -10,11 +10,12 @@ from statsmodels.stats.weightstats import DescrStatsW
 from geopandas import GeoDataFrame
 from shapely.geometry import Point
 from math import radians, cos, sin, asin, sqrt
-from timezonefinder import TimezoneFinder
 from shapely.geometry import Polygon
 import seaborn as sns
 import matplotlib.pyplot as plt
 import matplotlib as mpl
+import tz_raster
+import calendar_dim
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
@@ -79,12 +80,79 @@ def bootstrap_median_and_error(df, target_col, weight_col, n_bootstrap=1000):
 def get_timezone(longitude, latitude):
     if longitude is None or latitude is None:
         return None
-    tzf = TimezoneFinder()
-    try:
-        timeZone = tzf.timezone_at(lng=longitude, lat=latitude)
-    except:
-        timeZone = None
-    return timeZone
+    return tz_raster.timezone_at(longitude, latitude)
+
+
+# UTM projection constants, the same series and (WGS84) ellipsoid as utm.from_latlon
+utm_k0 = 0.9996
+utm_e = 0.00669438
+utm_e_p2 = utm_e / (1 - utm_e)
+utm_m = (1 - utm_e / 4 - 3 * utm_e ** 2 / 64 - 5 * utm_e ** 3 / 256,
+         3 * utm_e / 8 + 3 * utm_e ** 2 / 32 + 45 * utm_e ** 3 / 1024,
+         15 * utm_e ** 2 / 256 + 45 * utm_e ** 3 / 1024,
+         35 * utm_e ** 3 / 3072)
+utm_r = 6378137
+
+
+def utm_zone_number(latitude, longitude):
+    """
+    UTM zone of each point, including the Norway and Svalbard exceptions
+    :param latitude: array of latitudes
+    :param longitude: array of longitudes in [-180, 180)
+    :return: float array of zone numbers, NaN for missing points and points outside lat [-80, 84] / lon [-180, 180)
+    """
+    latitude, longitude = np.asarray(latitude, dtype=float), np.asarray(longitude, dtype=float)
+    with np.errstate(invalid='ignore'):
+        valid = (latitude >= -80) & (latitude <= 84) & (longitude >= -180) & (longitude < 180)
+        zone = np.floor((longitude + 180) / 6) + 1
+        zone = np.where((latitude >= 56) & (latitude < 64) & (longitude >= 3) & (longitude < 12), 32, zone)
+        svalbard = (latitude >= 72) & (latitude <= 84) & (longitude >= 0)
+        for lon_max, z in ((9, 31), (21, 33), (33, 35), (42, 37)):
+            zone = np.where(svalbard & (longitude < lon_max), z, zone)
+            svalbard = svalbard & (longitude >= lon_max)
+    return np.where(valid, zone, np.nan)
+
+
+def latlon_to_utm(latitude, longitude, zone=None):
+    """
+    Vectorized equivalent of utm.from_latlon for whole coordinate arrays
+    :param latitude: array of latitudes
+    :param longitude: array of longitudes
+    :param zone: int, project all points into this zone (32 gives EPSG:25832 coordinates for Germany),
+    None uses each point's own zone
+    :return: easting, northing and zone arrays; points outside lat [-80, 84] / lon [-180, 180) are NaN
+    (their zone too, when zone is None)
+    """
+    latitude, longitude = np.asarray(latitude, dtype=float), np.asarray(longitude, dtype=float)
+    with np.errstate(invalid='ignore'):
+        valid = (latitude >= -80) & (latitude <= 84) & (longitude >= -180) & (longitude < 180)
+    lat = np.where(valid, latitude, np.nan)
+    lon = np.where(valid, longitude, np.nan)
+    if zone is None:
+        zone = utm_zone_number(lat, lon)
+    else:
+        zone = np.full(lat.shape, zone, dtype=np.int64)
+
+    lat_rad = np.radians(lat)
+    lat_sin, lat_cos = np.sin(lat_rad), np.cos(lat_rad)
+    lat_tan = lat_sin / lat_cos
+    lat_tan2 = lat_tan * lat_tan
+    lat_tan4 = lat_tan2 * lat_tan2
+    central_lon_rad = np.radians((zone - 1) * 6 - 180 + 3)
+
+    n = utm_r / np.sqrt(1 - utm_e * lat_sin ** 2)
+    c = utm_e_p2 * lat_cos ** 2
+    a = lat_cos * ((np.radians(lon) - central_lon_rad + np.pi) % (2 * np.pi) - np.pi)
+    m = utm_r * (utm_m[0] * lat_rad - utm_m[1] * np.sin(2 * lat_rad) +
+                 utm_m[2] * np.sin(4 * lat_rad) - utm_m[3] * np.sin(6 * lat_rad))
+
+    easting = utm_k0 * n * (a + a ** 3 / 6 * (1 - lat_tan2 + c) +
+                            a ** 5 / 120 * (5 - 18 * lat_tan2 + lat_tan4 + 72 * c - 58 * utm_e_p2)) + 500000
+    northing = utm_k0 * (m + n * lat_tan * (a ** 2 / 2 +
+                                            a ** 4 / 24 * (5 - lat_tan2 + 9 * c + 4 * c ** 2) +
+                                            a ** 6 / 720 * (61 - 58 * lat_tan2 + lat_tan4 + 600 * c - 330 * utm_e_p2)))
+    northing = np.where(lat < 0, northing + 10000000, northing)
+    return easting, northing, zone
 
 
 def within_de_time(latitude, longitude):
@@ -94,41 +162,64 @@ def within_de_time(latitude, longitude):
     return 0
 
 
+def within_de_mask(latitude, longitude):
+    """
+    Array version of within_de_time
+    :param latitude: array of latitudes
+    :param longitude: array of longitudes
+    :return: int8 array, 1 for records inside the Germany bounding box
+    """
+    latitude, longitude = np.asarray(latitude, dtype=float), np.asarray(longitude, dtype=float)
+    return ((latitude >= de_box[1]) & (latitude <= de_box[3]) &
+            (longitude >= de_box[0]) & (longitude <= de_box[2])).astype(np.int8)
+
+
+def low_precision_mask(latitude, longitude):
+    """
+    Array version of the low-precision check of 2-raw-parquet-remove-low-precision: a record is low precision
+    if both coordinates have at most two decimals, or if any coordinate is missing or infinite
+    :param latitude: array of latitudes
+    :param longitude: array of longitudes
+    :return: boolean array, true for low-precision records
+    """
+    def few_decimals(x):
+        # x has <= 2 decimals if x * 100 is integral or x is the float closest to round(x * 100) / 100
+        s = x * 100
+        r = np.rint(s)
+        return (r == s) | (r / 100 == x)
+
+    latitude, longitude = np.asarray(latitude, dtype=float), np.asarray(longitude, dtype=float)
+    with np.errstate(invalid='ignore'):
+        return ~(np.isfinite(latitude) & np.isfinite(longitude)) | (few_decimals(latitude) & few_decimals(longitude))
+
+
 class TimeProcessing:
     def __init__(self, data=None):
         # device_aid, timestamp, latitude, longitude
         self.data = data
 
     def time_processing(self):
-        tqdm.pandas()
-        self.data.loc[:, 'datetime'] = self.data['timestamp'].progress_apply(lambda x: datetime.fromtimestamp(x))
-        self.data.loc[:, 'de_time'] = self.data.\
-            progress_apply(lambda row: within_de_time(row['latitude'], row['longitude']), axis=1)
-        print("Share of data in Germany time: %.2f %%" % (self.data.loc[:, 'de_time'].sum() / len(self.data) * 100))
+        utc = pd.to_datetime(self.data['timestamp'], unit='s', utc=True)
+        self.data.loc[:, 'datetime'] = utc.dt.tz_localize(None)
+        de_time = within_de_mask(self.data['latitude'].values, self.data['longitude'].values)
+        print("Share of data in Germany time: %.2f %%" % (de_time.sum() / max(len(self.data), 1) * 100))
         # Focus on Germany, skipping functions of time_zone_parallel and convert_to_local_time
-        self.data = self.data.loc[self.data['de_time'] == 1, :]
+        keep = de_time == 1
+        self.data = self.data.loc[keep, :]
         k = 'Europe/Berlin'
-        self.data = self.data.drop(columns=['de_time'])
-        self.data.loc[:, "localtime"] = self.data['datetime'].dt.tz_localize('UTC').dt.tz_convert(k)
+        self.data.loc[:, "localtime"] = utc[keep].dt.tz_convert(k)
         print('Time processed done.')
 
     def time_zone_parallel(self):
         df_sub = self.data.loc[self.data.de_time == 0, :].copy()
         df_de = self.data.loc[self.data.de_time == 1, :].copy()
         df_de.loc[:, 'tzname'] = 'Europe/Berlin'
-
-        def find_time_zone(data):
-            data.loc[:, 'tzname'] = data.apply(lambda row: get_timezone(row['longitude'], row['latitude']), axis=1)
-            return data
-
-        df_sub.loc[:, 'batch'] = np.random.randint(1, 101, df_sub.shape[0])
-        rstl = p_map(find_time_zone, [g for _, g in df_sub.groupby('batch', group_keys=True)])
-        df_sub = pd.concat(rstl)
+        df_sub.loc[:, 'tzname'] = tz_raster.timezone_lookup(df_sub['longitude'].values, df_sub['latitude'].values)
         L_before = len(df_sub)
         df_sub = df_sub[df_sub.tzname.notna()]
         L_after = len(df_sub)
         print("Share of data remained after removing unknown timezone: %.2f %%" % (L_after / L_before * 100))
-        self.data = pd.concat([df_de, df_sub.drop(columns=['batch'])])
+        self.data = pd.concat([df_de, df_sub])
         self.data = self.data.drop(columns=['de_time'])
 
     def convert_to_local_time(self):
@@ -149,15 +240,25 @@ class TimeProcessing:
         self.data = pd.concat(rstl1 + rstl2)
         # print(self.data.iloc[0])
 
-    def time_enrich(self):
+    def time_enrich(self, compact=False):
+        """
+        Add hour, month, year, weekday, week (ISO) and date of the local time.
+        :param compact: boolean, if true, the integer fields are int8 (int16 for year) and records
+        without a valid local time get -1
+        """
         # Add start time hour and duration in minute
         self.data['localtime'] = pd.to_datetime(self.data['localtime'], errors='coerce')
-        self.data.loc[:, 'hour'] = self.data.loc[:, 'localtime'].dt.hour
-        self.data.loc[:, 'month'] = self.data.loc[:, 'localtime'].dt.month
-        self.data.loc[:, 'year'] = self.data.loc[:, 'localtime'].dt.year
-        self.data.loc[:, 'weekday'] = self.data.loc[:, 'localtime'].dt.dayofweek
-        self.data.loc[:, 'week'] = self.data.loc[:, 'localtime'].dt.isocalendar().week
-        self.data.loc[:, 'date'] = self.data.loc[:, 'localtime'].dt.date
+        wall_ns, valid = calendar_dim.wall_clock_ns(self.data['localtime'])
+        fields = calendar_dim.calendar_fields(wall_ns)
+        for var in ('hour', 'month', 'year', 'weekday', 'week'):
+            if compact:
+                dtype = np.int16 if var == 'year' else np.int8
+                self.data.loc[:, var] = np.where(valid, fields[var], -1).astype(dtype)
+            elif valid.all():
+                self.data.loc[:, var] = fields[var].astype(np.int32)
+            else:
+                self.data.loc[:, var] = np.where(valid, fields[var], np.nan)
+        self.data.loc[:, 'date'] = np.where(valid, fields['date'].astype(object), None)
         # Add individual sequence index
         self.data = self.data.sort_values(by=['device_aid', 'timestamp'], ascending=True)
         #
@@ -188,19 +289,12 @@ class TimeProcessingStops:
         df_sub = self.data.loc[self.data.de_time == 0, :].copy()
         df_de = self.data.loc[self.data.de_time == 1, :].copy()
         df_de.loc[:, 'tzname'] = 'Europe/Berlin'
-
-        def find_time_zone(data):
-            data.loc[:, 'tzname'] = data.apply(lambda row: get_timezone(row['longitude'], row['latitude']), axis=1)
-            return data
-
-        df_sub.loc[:, 'grp'] = np.random.randint(1, 101, df_sub.shape[0])
-        rstl = p_map(find_time_zone, [g for _, g in df_sub.groupby('grp', group_keys=True)])
-        df_sub = pd.concat(rstl)
+        df_sub.loc[:, 'tzname'] = tz_raster.timezone_lookup(df_sub['longitude'].values, df_sub['latitude'].values)
         L_before = len(df_sub)
         df_sub = df_sub[df_sub.tzname.notna()]
         L_after = len(df_sub)
         print("Share of data remained after removing unknown timezone: %.2f %%" % (L_after / L_before * 100))
-        self.data = pd.concat([df_de, df_sub.drop(columns=['grp'])])
+        self.data = pd.concat([df_de, df_sub])
         self.data = self.data.drop(columns=['de_time'])
 
     def convert_to_local_time(self):
@@ -226,10 +320,12 @@ class TimeProcessingStops:
         # Add start time hour and duration in minute
         for var, fx in zip(('localtime', 'leaving_localtime'), ('', 'leaving_')):
             self.data[var] = pd.to_datetime(self.data[var], errors='coerce')
-            self.data.loc[:, f'{fx}hour'] = self.data.loc[:, var].dt.hour
-            self.data.loc[:, f'{fx}weekday'] = self.data.loc[:, var].dt.dayofweek
-            self.data.loc[:, f'{fx}week'] = self.data.loc[:, var].dt.isocalendar().week
-            self.data.loc[:, f'{fx}date'] = self.data.loc[:, var].dt.date
+            wall_ns, valid = calendar_dim.wall_clock_ns(self.data[var])
+            fields = calendar_dim.calendar_fields(wall_ns)
+            for x in ('hour', 'weekday', 'week'):
+                self.data.loc[:, f'{fx}{x}'] = fields[x].astype(np.int32) if valid.all() else \
+                    np.where(valid, fields[x], np.nan)
+            self.data.loc[:, f'{fx}date'] = np.where(valid, fields['date'].astype(object), None)
         # Add individual sequence index
         self.data = self.data.sort_values(by=['device_aid', 'start'], ascending=True)
 
@@ -241,6 +337,154 @@ class TimeProcessingStops:
         self.data = pd.concat(reslt)
 
 
+def week_hour_bitsets(device_code=None, week=None, hour_of_week=None):
+    """
+    Reduce records to one 168-bit active-hour bitset per device-week.
+    :param device_code: int array, device codes (e.g., from pd.factorize)
+    :param week: int array, ISO week number
+    :param hour_of_week: int array, weekday * 24 + hour
+    :return: int64 array of device codes, int64 array of weeks, (n, 3) uint64 array of bitsets
+    """
+    key = device_code.astype(np.int64) * 54 + week.astype(np.int64)
+    key_code, keys = pd.factorize(key, sort=True)
+    hour_of_week = hour_of_week.astype(np.int64)
+    bits = np.zeros((len(keys), 3), dtype=np.uint64)
+    np.bitwise_or.at(bits, (key_code, hour_of_week // 64),
+                     np.left_shift(np.uint64(1), (hour_of_week % 64).astype(np.uint64)))
+    return keys // 54, keys % 54, bits
+
+
+def popcount(bits):
+    """
+    :param bits: (n, k) uint64 array
+    :return: int64 array, number of set bits per row
+    """
+    return np.unpackbits(np.ascontiguousarray(bits).view(np.uint8), axis=1).sum(axis=1).astype(np.int64)
+
+
+def device_completeness(data=None):
+    """
+    Data completeness per device in one pass (vectorized q_completeness of 3-parquet-to-statistics).
+    Weeks are keyed by ISO week number, as in the per-device groupby; q_hour_sd is the sample standard
+    deviation over weeks and 0 for devices active in one week only.
+    :param data: dataframe with device_aid, timestamp, date, week, weekday and hour
+    :return: dataframe of device_aid, no_active_days, total_days, q_day, q_hour_m, q_hour_sd and no_rec
+    """
+    total_hours = 168
+    device_code, devices = pd.factorize(data['device_aid'], sort=True)
+    n = len(devices)
+    no_rec = np.bincount(device_code, minlength=n)
+
+    # Overall q
+    date_code, dates = pd.factorize(data['date'])
+    active_days = np.unique(device_code.astype(np.int64) * len(dates) + date_code)
+    no_active_days = np.bincount(active_days // len(dates), minlength=n)
+    timestamp = data['timestamp'].values
+    ts_min = np.full(n, np.iinfo(np.int64).max)
+    ts_max = np.full(n, np.iinfo(np.int64).min)
+    np.minimum.at(ts_min, device_code, timestamp)
+    np.maximum.at(ts_max, device_code, timestamp)
+    total_days = np.ceil((ts_max - ts_min) / 3600 / 24 + 1)
+    q_day = no_active_days / np.maximum(total_days, 1)
+
+    # Weekly q
+    hour_of_week = data['weekday'].values.astype(np.int64) * 24 + data['hour'].values.astype(np.int64)
+    dw_device, _, bits = week_hour_bitsets(device_code, data['week'].values, hour_of_week)
+    q_hour = popcount(bits) / total_hours
+    no_weeks = np.bincount(dw_device, minlength=n)
+    q_hour_m = np.bincount(dw_device, weights=q_hour, minlength=n) / no_weeks
+    sq_dev = np.bincount(dw_device, weights=(q_hour - q_hour_m[dw_device]) ** 2, minlength=n)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        q_hour_sd = np.where(no_weeks > 1, np.sqrt(sq_dev / (no_weeks - 1)), 0)
+
+    return pd.DataFrame(dict(device_aid=devices, no_active_days=no_active_days.astype(float),
+                             total_days=total_days, q_day=q_day, q_hour_m=q_hour_m, q_hour_sd=q_hour_sd,
+                             no_rec=no_rec.astype(float)))
+
+
+def night_samples(localtime=None, l_localtime=None, start_night='22:00', end_night='07:00', freq_minutes=15):
+    """
+    Per stay, the number of points of pd.date_range(localtime, l_localtime, freq=f'{freq_minutes}min') and
+    how many of them fall in the night window (between_time(start_night, end_night), both ends included),
+    computed from the stay bounds without generating the points. The points of a stay are the slots
+    start + k * freq of the wall clock, so the night count is a difference of slot counts over whole days plus
+    the remainders; stays crossing a change of the UTC offset (daylight saving) are counted point by point.
+    :param localtime: datetime series (tz-aware or naive), stay start
+    :param l_localtime: datetime series, stay end
+    :param start_night: str, 'HH:MM'
+    :param end_night: str, 'HH:MM'
+    :param freq_minutes: int, a divisor of 24 * 60
+    :return: int64 array of points, int64 array of night points
+    """
+    step, day = np.int64(freq_minutes * 60 * 10 ** 9), np.int64(86400 * 10 ** 9)
+    if day % step != 0:
+        raise ValueError(f'freq_minutes must divide a day: {freq_minutes}')
+    slots = day // step
+    sn, en = (pd.Timedelta(f'{x}:00').value for x in (start_night, end_night))
+    tz = localtime.dt.tz
+
+    def ns(series):
+        utc = series.dt.tz_convert('UTC').dt.tz_localize(None) if tz is not None else series
+        wall = series.dt.tz_localize(None) if tz is not None else series
+        return utc.values.astype('datetime64[ns]').astype(np.int64), \
+            wall.values.astype('datetime64[ns]').astype(np.int64)
+
+    start_utc, start_wall = ns(localtime)
+    end_utc, end_wall = ns(l_localtime)
+    points = np.where(end_utc >= start_utc, (end_utc - start_utc) // step + 1, 0)
+
+    # Night slots of a day are [0, hi] and [lo, slots - 1] (or [lo, hi] for a window within a day),
+    # for the slots q + j * step of the phase q of the stay
+    q = start_wall % step
+    lo = np.clip(-((q - sn) // step), 0, slots)
+    hi = np.clip((en - q) // step, -1, slots - 1)
+
+    def below(r):
+        # Night slots j < r, for 0 <= r <= slots
+        if sn > en:
+            return np.clip(r, 0, hi + 1) + np.clip(r - lo, 0, None)
+        return np.clip(np.minimum(r, hi + 1) - lo, 0, None)
+
+    def prefix(m):
+        return (m // slots) * below(slots) + below(m % slots)
+
+    j0 = (start_wall % day) // step
+    night = prefix(j0 + points) - prefix(j0)
+
+    shifted = np.flatnonzero(((end_wall - end_utc) != (start_wall - start_utc)) & (points > 0))
+    if len(shifted) > 0:
+        rows = np.repeat(shifted, points[shifted])
+        k = np.arange(len(rows)) - np.repeat(np.cumsum(points[shifted]) - points[shifted], points[shifted])
+        wall = pd.DatetimeIndex(start_utc[rows] + k * step, tz='UTC').tz_convert(tz).tz_localize(None)
+        tod = wall.values.astype('datetime64[ns]').astype(np.int64) % day
+        is_night = ((tod >= sn) | (tod <= en)) if sn > en else ((tod >= sn) & (tod <= en))
+        night[shifted] = np.bincount(np.searchsorted(shifted, rows), weights=is_night,
+                                     minlength=len(shifted)).astype(np.int64)
+    return points.astype(np.int64), night.astype(np.int64)
+
+
+def home_locations(data=None, start_night='22:00', end_night='07:00', freq_minutes=15, key='device_aid'):
+    """
+    Home of each device: the location (latitude, longitude) with the most night points, or with the most
+    points if the device has none at night, where the stays are sampled every freq_minutes from start to end
+    (skmob's home_location over the stays exploded into 15-min points, see night_samples).
+    Ties go to the smallest latitude, then longitude.
+    :param data: dataframe of stays with key, latitude, longitude, localtime and l_localtime
+    :param key: str, device column, device_aid or device_id
+    :return: dataframe of key, latitude and longitude, one row per device with at least one point
+    """
+    points, night = night_samples(data['localtime'], data['l_localtime'], start_night=start_night,
+                                  end_night=end_night, freq_minutes=freq_minutes)
+    df = pd.DataFrame({key: data[key].values, 'latitude': data['latitude'].values,
+                       'longitude': data['longitude'].values, 'points': points, 'night': night})
+    df = df.groupby([key, 'latitude', 'longitude'], as_index=False)[['points', 'night']].sum()
+    has_night = df.groupby(key)['night'].transform('sum') > 0
+    df['score'] = np.where(has_night, df['night'], df['points'])
+    df = df.loc[df['score'] > 0].sort_values([key, 'score', 'latitude', 'longitude'],
+                                             ascending=[True, False, True, True])
+    return df.drop_duplicates(key)[[key, 'latitude', 'longitude']].reset_index(drop=True)
+
+
 def df2gdf_point(df, x_field, y_field, crs=4326, drop=True):
     """
     Convert two columns of GPS coordinates into POINT geo dataframe
@@ -2,27 +2,83 @@ import sys
 from pathlib import Path
 import os
 import pandas as pd
-import utm
 import time
-from p_tqdm import p_map
-from tqdm import tqdm
 import numpy as np
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import pyarrow as pa
+import pyarrow.csv as pv
 
 
 ROOT_dir = Path(__file__).parent.parent.parent
 sys.path.append(ROOT_dir)
 sys.path.insert(0, os.path.join(ROOT_dir, 'lib'))
 
+import workers
+import partitioner
+import mad_store
+import device_dict
 
-def by_batch(data):
-    def utm_converter(row):
+
+raw_column_types = {'timestamp': pa.int64(), 'device_aid': pa.string(),
+                    'latitude': pa.float64(), 'longitude': pa.float64(),
+                    'location_method': pa.string()}
+
+
+def read_day_batches(file_paths, selectedcols=None, block_size=64 << 20, num_threads=4, max_batches=8):
+    """
+    Stream the records of a day's .csv.gz files as Arrow record batches.
+    Each reader thread decompresses and parses one file at a time, and at most max_batches
+    parsed batches wait in memory, so peak memory is bounded by (num_threads + max_batches) * block_size
+    regardless of how many pings the day has.
+    :param file_paths: list of .csv.gz files (tab separated)
+    :param selectedcols: a list of column names
+    :param block_size: int, bytes of uncompressed csv parsed per batch
+    :param num_threads: int, number of files decompressed concurrently
+    :param max_batches: int, number of parsed batches allowed to wait for the consumer
+    :return: generator of pyarrow.RecordBatch
+    """
+    files = queue.Queue()
+    for file_path in file_paths:
+        files.put(file_path)
+    batches = queue.Queue(maxsize=max_batches)
+    done = object()
+    read_options = pv.ReadOptions(block_size=block_size, use_threads=True)
+    parse_options = pv.ParseOptions(delimiter='\t')
+    convert_options = pv.ConvertOptions(include_columns=selectedcols,
+                                        column_types={k: v for k, v in raw_column_types.items()
+                                                      if (selectedcols is None) or (k in selectedcols)})
+
+    def reader():
         try:
-            res = utm.from_latlon(row['latitude'], row['longitude'])
-            return [res[0], res[1]]
-        except:
-            return [np.nan, np.nan]
-    data[['utm_x', 'utm_y']] = data.apply(utm_converter, axis=1, result_type='expand')
-    return data
+            while True:
+                try:
+                    file_path = files.get_nowait()
+                except queue.Empty:
+                    break
+                print(f'Loading {file_path}')
+                with pa.CompressedInputStream(pa.OSFile(file_path), 'gzip') as stream:
+                    for batch in pv.open_csv(stream, read_options=read_options,
+                                             parse_options=parse_options, convert_options=convert_options):
+                        batches.put(batch)
+        except Exception as e:
+            batches.put(e)
+        batches.put(done)
+
+    num_threads = max(1, min(num_threads, len(file_paths)))
+    threads = [threading.Thread(target=reader, daemon=True) for _ in range(num_threads)]
+    for t in threads:
+        t.start()
+    finished = 0
+    while finished < num_threads:
+        item = batches.get()
+        if item is done:
+            finished += 1
+        elif isinstance(item, Exception):
+            raise item
+        else:
+            yield item
 
 
 class DataPrep:
@@ -32,208 +88,128 @@ class DataPrep:
         :rtype: None
         """
         self.raw_data_folder = 'E:\\MAD_dbs\\raw_data_de_2'  # under the local drive D
-        self.converted_data_folder = 'D:\\MAD_dbs\\raw_data_de\\format_parquet_b'
-        self.data = None
-        self.devices = None
-
-    def device_logging(self, year=None, month=None):
-        devices_m = []
-        days_list = get_day_list(month=month)
-        # Due to an accident, this date is lost
-        if (month == '05') & (year == 2019):
-            days_list.remove('14')
-        for day in days_list:
-            df_list = []
-            # path = os.path.join(self.raw_data_folder, f'raw_data_de_{y}', m, day)
-            path = os.path.join(self.raw_data_folder, f'{y}', m, day)
-            file_list = os.listdir(path)
-            for file in file_list:
-                file_path = os.path.join(path, file)
-                print(f'Loading {file_path}')
-                df_list.append(pd.read_csv(file_path, sep='\t', compression='gzip', usecols=['device_aid']))
-            temp_ = pd.concat(df_list)
-            temp_ = temp_[temp_.device_aid.apply(lambda x: isinstance(x, str))]
-            devices_m.append(temp_['device_aid'].unique())
-            del temp_
-        devices_m = np.unique(np.concatenate(devices_m))
-        devices_m = pd.DataFrame(devices_m, columns=['uid'])
-        devices_m.to_parquet(f'dbs/devices/devices_{year}_{month}.parquet', index=False)
-
-    def device_grouping(self, num_groups=300):
-        file_path = os.path.join(ROOT_dir, 'dbs/devices/devices_grp.parquet')
-        if os.path.isfile(file_path):
-            print('Loading existing groups...')
-            self.devices = pd.read_parquet(file_path) # uid, batch = group
-            self.devices.rename(columns={'uid': 'device_aid', 'batch': 'grp'}, inplace=True)
-            # self.devices.rename(columns={'batch': 'grp'}, inplace=True)
-            # self.devices = {x: devices.loc[devices.batch == x, 'uid'].to_list() for x in range(0, num_groups)}
-        else:
-            print('Grouping users...')
-            devices = []
-            for year in (2019, 2022, 2023):
-                year_df_list = []
-                for month in ('05', '06', '07', '08', '09'):
-                    print(f'Processing {year} - {month}...')
-                    year_df_list.append(pd.read_parquet(os.path.join(ROOT_dir, f'dbs/devices/devices_{year}_{month}.parquet')))
-                df_year = pd.concat(year_df_list)
-                del year_df_list
-                df_year.drop_duplicates(subset=['uid'], inplace=True)
-                devices.append(df_year)
-                del df_year
-            devices = pd.concat(devices)
-            devices.drop_duplicates(subset=['uid'], inplace=True)
-            np.random.seed(68)
-            devices.loc[:, 'batch'] = np.random.randint(0, num_groups, size=len(devices))
-            devices.to_parquet(file_path, index=False)
-            self.devices = {x: devices.loc[devices.batch == x, 'uid'].to_list() for x in range(0, num_groups)}
-
-    def process_data(self, selectedcols=None, month=None, year=None, day=None):
+        # self.converted_data_folder = 'D:\\MAD_dbs\\raw_data_de\\format_parquet_b'
+        self.converted_data_folder = 'D:\\MAD_dbs\\raw_data_de\\format_parquet_h'  # grp=/year=/month=/day=
+        self.grouper = None
+
+    def device_grouping(self, num_groups=300, legacy=False):
+        """
+        Devices are assigned to groups by a seeded hash of device_aid (partitioner.device_group),
+        so no device list needs to be logged and merged beforehand.
+        :param num_groups: number of user groups
+        :param legacy: if true, devices in dbs/devices/devices_grp.parquet keep their stored group
+        :return: None
+        """
+        self.grouper = partitioner.DeviceGrouper(num_groups=num_groups, legacy=legacy)
+
+    def process_data_stream(self, selectedcols=None, month=None, year=None, day=None,
+                            block_size=64 << 20, num_threads=4, memory_budget=2 << 30, add_utm=False,
+                            drop_low_precision=False, part=0, groups=None, file_paths=None):
         """
+        Convert one day: the day's files are read as Arrow record batches, each batch is tagged with grp and
+        handed to the group writer, so peak memory is set by block_size, num_threads and memory_budget
+        instead of the size of the day.
         :param selectedcols: a list of column names
         :type selectedcols: list
+        :param block_size: int, bytes of uncompressed csv parsed per batch
+        :param num_threads: int, number of files decompressed concurrently
+        :param memory_budget: int, bytes of tagged rows buffered before writing row groups
+        :param add_utm: boolean, if true, utm_x and utm_y are computed inline for every batch
+        :param drop_low_precision: boolean, if true, low-precision records (workers.low_precision_mask) are dropped
+        while writing, which replaces the separate pass of 2-raw-parquet-remove-low-precision
+        :param part: int, 0 reads all files of the day, 1 and 2 the halves of the days converted in two parts
+        before streaming
+        :param groups: list of groups to write (for repairs), None writes all groups
+        :param file_paths: list of raw file paths to read instead of the files of part (for repairs)
         """
         start = time.time()
-        print("Data loading...")
-        # path = os.path.join(self.raw_data_folder, f'raw_data_de_{year}', month, day)
-        path = os.path.join(self.raw_data_folder, f'{year}', month, day)
-        file_list = os.listdir(path)
-        n = int(len(file_list) / 2)
-        file_list_tuple = (file_list[:n], file_list[n:])
-        self.data = []
-        for file_list in file_list_tuple:
-            df_list = []
-            for file in file_list:
-                file_path = os.path.join(path, file)
-                print(f'Loading {file_path}')
-                df_list.append(pd.read_csv(file_path, sep='\t', compression='gzip', usecols=selectedcols))
-            temp_ = pd.concat(df_list)
-            del df_list
-            # # Process coordinates (dropped for the second batch)
-            # np.random.seed(68)
-            # temp_.loc[:, 'batch'] = np.random.randint(0, 16, size=len(temp_))
-            # print('Process coordinates...')
-            # rstl = p_map(by_batch, [g for _, g in temp_.groupby('batch', group_keys=True)])
-            # temp_ = pd.concat(rstl)
-            # del rstl
-            # temp_.drop(columns=['batch'], inplace=True)
-            print('Adding group id to device_aids...')
-            temp_ = pd.merge(temp_, self.devices[['device_aid', 'grp']],
-                             on='device_aid', how='left')
-            self.data.append(temp_)
-            del temp_
-        end = time.time()
-        print(f"Data processed in {(end - start)/60} minutes.")
-
-    def write_out(self, year=None, month=None, day=None):
-        def write_data(data=None, hf=None):
-            dirs = [x[0] for x in os.walk(self.converted_data_folder)]
-            grp = data.name
-            target_dir = os.path.join(self.converted_data_folder, 'grp_' + str(int(grp)))
-            if target_dir not in dirs:
-                os.makedirs(target_dir)
-                print("created folder : ", target_dir)
-            data.to_parquet(os.path.join(target_dir, f'{year}_' + month + '_' + day + f'_{hf}.parquet'))
-
-        for d, hf in zip(self.data, (1, 2)):
-            print(f'Saving half {hf}')
-            tqdm.pandas()
-            d.groupby('grp').progress_apply(lambda x: write_data(data=x, hf=hf))
-
-    def dump_to_parquet(self, day=None, year=None, month=None):
-        # Save data to database
-        start = time.time()
-        print('Saving data...')
-        for grp in tqdm(range(0, len(self.devices)), desc='Saving data'):
-            self.write_out(grp=grp, year=year, day=day, month=month)
-        self.data = None
+        if file_paths is None:
+            path = os.path.join(self.raw_data_folder, f'{year}', month, day)
+            file_list = os.listdir(path)
+            n = int(len(file_list) / 2)
+            file_list = {0: file_list, 1: file_list[:n], 2: file_list[n:]}[part]
+            file_paths = [os.path.join(path, file) for file in file_list]
+        writer = mad_store.PartitionedDayWriter(root=self.converted_data_folder, year=year, month=month, day=day,
+                                                part=part, memory_budget=memory_budget, sources=file_paths,
+                                                groups=range(self.grouper.num_groups) if groups is None else groups)
+        rows_read = 0
+        for batch in read_day_batches(file_paths, selectedcols=selectedcols, block_size=block_size,
+                                      num_threads=num_threads):
+            table = pa.Table.from_batches([batch])
+            rows_read += table.num_rows
+            if drop_low_precision:
+                table = table.filter(pa.array(~workers.low_precision_mask(table.column('latitude').to_numpy(),
+                                                                          table.column('longitude').to_numpy())))
+            if add_utm:
+                utm_x, utm_y, _ = workers.latlon_to_utm(table.column('latitude').to_numpy(),
+                                                        table.column('longitude').to_numpy())
+                table = table.append_column('utm_x', pa.array(utm_x)).append_column('utm_y', pa.array(utm_y))
+            grp = self.grouper.assign(table.column('device_aid'))
+            if groups is not None:
+                grp[~np.isin(grp, groups)] = -1
+            writer.write(table=table, grp=grp)
+        rows = sum(writer.close().values())
         end = time.time()
-        print(f"Data saved in {(end - start)/60} minutes.")
+        print(f"Data processed in {(end - start)/60} minutes ({rows} records).")
+        if drop_low_precision:
+            print("Share of low-precision records removed: %.2f %%" % ((1 - rows / max(rows_read, 1)) * 100))
+        return rows
 
-    def reprocess_single_data_file(self, selectedcols=None, month=None, year=None, day=None, grp=None):
+    def reprocess_single_day(self, selectedcols=None, month=None, year=None, day=None, groups=None):
         """
+        Convert one day again, every part recorded in the manifest from its recorded raw files
+        (see reprocess_partitions), so a day converted in two halves is rewritten as the same two parts.
         :param selectedcols: a list of column names
-        :type selectedcols: list
+        :param groups: list of groups to write, None writes all groups
         """
+        manifest = mad_store.read_manifest(root=self.converted_data_folder, empty=True)
+        parts = manifest.loc[(manifest['year'] == int(year)) & (manifest['month'] == int(month)) &
+                             (manifest['day'] == int(day)), 'part']
+        problems = pd.DataFrame([(g, int(year), int(month), int(day), part)
+                                 for part in sorted(set(parts)) or [0] for g in (groups or [-1])],
+                                columns=['grp', 'year', 'month', 'day', 'part'])
+        self.reprocess_partitions(problems=problems, selectedcols=selectedcols)
 
-        target_dir = os.path.join(self.converted_data_folder, 'grp_' + str(grp))
-
-        start = time.time()
-        print("Data loading...")
-        path = os.path.join(self.raw_data_folder, f'raw_data_de_{year}', month, day)
-        file_list = os.listdir(path)
-        n = int(len(file_list) / 2)
-        file_list_tuple = (file_list[:n], file_list[n:])
-        for file_list, hf in zip(file_list_tuple, range(1, 3)):
-            print(f"Half {hf} is being processed.")
-            df_list = []
-            for file in file_list:
-                file_path = os.path.join(path, file)
-                print(f'Loading {file_path}')
-                df_list.append(pd.read_csv(file_path, sep='\t', compression='gzip', usecols=selectedcols))
-            temp_ = pd.concat(df_list)
-            del df_list
-
-            print('Adding group id to device_aids...')
-            temp_ = pd.merge(temp_, self.devices[['device_aid', 'grp']],
-                             on='device_aid', how='left')
-            temp_ = temp_.loc[temp_['grp'] == grp, :]
-            temp_.loc[:, 'grp'] = temp_.loc[:, 'grp'].astype(int)
-
-            # Process coordinates
-            print('Process coordinates...')
-            np.random.seed(68)
-            temp_.loc[:, 'batch'] = np.random.randint(0, 16, size=len(temp_))
-            rstl = p_map(by_batch, [g for _, g in temp_.groupby('batch', group_keys=True)])
-            temp_ = pd.concat(rstl)
-            del rstl
-            temp_.drop(columns=['batch'], inplace=True)
-
-            # Write out
-            temp_.to_parquet(os.path.join(target_dir, f'{year}_' + month + '_' + day + f'_{hf}.parquet'))
+    def reprocess_single_data_file(self, selectedcols=None, month=None, year=None, day=None, grp=None):
+        """
+        Convert one day again for a single group.
+        :param selectedcols: a list of column names
+        """
+        self.reprocess_single_day(selectedcols=selectedcols, month=month, year=year, day=day, groups=[grp])
 
-        end = time.time()
-        print(f"Data processed in {(end - start)/60} minutes.")
+    def register_devices(self, days=None):
+        """
+        Add the devices of newly converted days to the shared device dictionary.
+        :param days: list of (year, month, day)
+        """
+        manifest = mad_store.read_manifest(root=self.converted_data_folder)
+        days = {(int(y), int(m), int(d)) for y, m, d in days}
+        manifest = manifest.loc[[x in days for x in zip(manifest['year'], manifest['month'], manifest['day'])]]
+        print(f'Registering devices of {len(manifest)} files...')
+        device_dict.DeviceDictionary().update_from_files(
+            file_paths=[os.path.join(self.converted_data_folder, x) for x in manifest['path']])
 
-    def reprocess_single_day(self, selectedcols=None, month=None, year=None, day=None):
+    def reprocess_partitions(self, problems=None, selectedcols=None):
         """
+        Re-run only the (day, part) inputs of the partitions reported by mad_store.verify_store,
+        writing only the affected groups; a missing day (grp = -1) is converted completely.
+        The inputs are the raw files recorded in the manifest of the (day, part), so a repair reads the same
+        files as the original conversion regardless of the listing order of the day folder.
+        :param problems: dataframe with grp, year, month, day, part
         :param selectedcols: a list of column names
-        :type selectedcols: list
         """
-        start = time.time()
-        print("Data loading...")
-        path = os.path.join(self.raw_data_folder, f'raw_data_de_{year}', month, day)
-        file_list = os.listdir(path)
-        n = int(len(file_list) / 2)
-        file_list_tuple = (file_list[:n], file_list[n:])
-        for file_list, hf in zip(file_list_tuple, range(1, 3)):
-            print(f"Half {hf} is being processed.")
-            df_list = []
-            for file in file_list:
-                file_path = os.path.join(path, file)
-                print(f'Loading {file_path}')
-                df_list.append(pd.read_csv(file_path, sep='\t', compression='gzip', usecols=selectedcols))
-            temp_ = pd.concat(df_list)
-            del df_list
-
-            print('Adding group id to device_aids...')
-            temp_ = pd.merge(temp_, self.devices[['device_aid', 'grp']],
-                             on='device_aid', how='left')
-            temp_.loc[:, 'grp'] = temp_.loc[:, 'grp'].astype(int)
-
-            # Process coordinates
-            print('Process coordinates...')
-            np.random.seed(68)
-            temp_.loc[:, 'batch'] = np.random.randint(0, 16, size=len(temp_))
-            rstl = p_map(by_batch, [g for _, g in temp_.groupby('batch', group_keys=True)])
-            temp_ = pd.concat(rstl)
-            del rstl
-            temp_.drop(columns=['batch'], inplace=True)
-            self.data = temp_
-            del temp_
-            # Write out
-            self.write_out(year=year, month=month, day=day)
-        end = time.time()
-        print(f"Data processed in {(end - start)/60} minutes.")
+        manifest = mad_store.read_manifest(root=self.converted_data_folder, empty=True)
+        sources = {k: sorted(set(x for files in v for x in files))
+                   for k, v in manifest.groupby(['year', 'month', 'day', 'part'])['sources']}
+        for (y, m, d, part), grps in problems.groupby(['year', 'month', 'day', 'part'])['grp']:
+            groups = None if (grps < 0).any() else sorted(set(grps))
+            month, day = '%02d' % m, '%02d' % d
+            path = os.path.join(self.raw_data_folder, f'{y}', month, day)
+            file_paths = [os.path.join(path, file) for file in sources[(y, m, d, part)]] \
+                if sources.get((y, m, d, part)) else None
+            print(f'Reprocessing {y}-{m:02d}-{d:02d} part {part} for groups {groups}...')
+            self.process_data_stream(selectedcols=selectedcols, year=y, month=month, day=day,
+                                     part=part, groups=groups, file_paths=file_paths)
 
 
 def get_day_list(month=None):
@@ -244,75 +220,128 @@ def get_day_list(month=None):
     return days
 
 
+def day_raw_size(raw_data_folder=None, year=None, month=None, day=None):
+    path = os.path.join(raw_data_folder, f'{year}', month, day)
+    return sum(os.path.getsize(os.path.join(path, file)) for file in os.listdir(path))
+
+
+data_prep_worker = None
+
+
+def init_day_worker(num_groups=300, legacy=False):
+    global data_prep_worker
+    data_prep_worker = DataPrep()
+    data_prep_worker.device_grouping(num_groups=num_groups, legacy=legacy)
+
+
+def convert_day_worker(selectedcols=None, year=None, month=None, day=None, stream_args=None):
+    start = time.time()
+    rows = data_prep_worker.process_data_stream(selectedcols=selectedcols, year=year, month=month, day=day,
+                                                **stream_args)
+    return rows, time.time() - start
+
+
+def convert_days_parallel(days=None, selectedcols=None, num_groups=300, legacy=False, ram_budget=48 << 30,
+                          worker_overhead=1 << 30, inflation=5, max_workers=None,
+                          block_size=64 << 20, num_threads=4, memory_budget=2 << 30, drop_low_precision=True):
+    """
+    Convert several days concurrently in a process pool. A day is only started if the estimated memory of
+    the running days stays within ram_budget; a day is estimated from its .csv.gz size on disk times inflation,
+    capped by the bounded memory of the streaming reader and writer.
+    :param days: list of (year, month, day)
+    :param selectedcols: a list of column names
+    :param legacy: boolean, if true, devices keep their stored group (partitioner.legacy_table); the lookup
+    table is built here once and memory-mapped by the workers, so its pages are shared and not per worker
+    :param ram_budget: int, bytes of RAM the running days may use in total
+    :param worker_overhead: int, bytes held by every worker process regardless of the day
+    :param inflation: float, in-memory bytes per compressed byte on disk
+    :param max_workers: int, upper bound of concurrent days, defaults to the number of cores
+    :param drop_low_precision: boolean, filter low-precision records while converting
+    :return: dataframe of per-day throughput
+    """
+    raw_data_folder = DataPrep().raw_data_folder
+    if legacy:
+        partitioner.legacy_table()
+    stream_args = dict(block_size=block_size, num_threads=num_threads, memory_budget=memory_budget,
+                       drop_low_precision=drop_low_precision)
+    stream_cap = block_size * (num_threads + 8) + 2 * memory_budget
+    max_workers = max_workers or os.cpu_count()
+    pending = [(y, m, d, day_raw_size(raw_data_folder=raw_data_folder, year=y, month=m, day=d)) for y, m, d in days]
+    estimate = {(y, m, d): worker_overhead + min(size * inflation, stream_cap) for y, m, d, size in pending}
+    stats = []
+    running = dict()
+    in_use = 0
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=init_day_worker,
+                             initargs=(num_groups, legacy)) as executor:
+        while pending or running:
+            # Admit days in order while they fit; always run at least one
+            while pending and (len(running) < max_workers):
+                y, m, d, size = pending[0]
+                if running and (in_use + estimate[(y, m, d)] > ram_budget):
+                    break
+                pending.pop(0)
+                in_use += estimate[(y, m, d)]
+                future = executor.submit(convert_day_worker, selectedcols=selectedcols,
+                                         year=y, month=m, day=d, stream_args=stream_args)
+                running[future] = (y, m, d, size)
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                y, m, d, size = running.pop(future)
+                in_use -= estimate[(y, m, d)]
+                rows, seconds = future.result()
+                stats.append(dict(year=y, month=m, day=d, rows=rows, size_mb=size / 2**20, seconds=seconds,
+                                  rows_per_s=rows / max(seconds, 1e-9),
+                                  mb_per_s=size / 2**20 / max(seconds, 1e-9)))
+                print(f"Day {y}-{m}-{d}: {rows} records in {seconds/60:.1f} minutes "
+                      f"({stats[-1]['rows_per_s']:.0f} rows/s, {stats[-1]['mb_per_s']:.1f} MB/s), "
+                      f"{len(running)} running, {len(pending)} waiting.")
+    stats = pd.DataFrame(stats)
+    end = time.time()
+    print(f"{len(stats)} days processed in {(end - start)/60} minutes "
+          f"({stats['rows'].sum() / (end - start):.0f} rows/s, {stats['size_mb'].sum() / (end - start):.1f} MB/s).")
+    return stats
+
+
 if __name__ == '__main__':
-    # Stage 1- Logging device ids
+    # Stage 1- Logging device ids (dropped, groups are assigned by hash of device_aid)
     # Stage 2- Processing files
-    # Stage 3- Fix problematic day-groups
+    # Stage 3- Verify the converted store against its manifest and re-run bad (grp, day, part) partitions
     # Stage 4- Fix single day for multiple groups
     stage = 2
-    if stage == 1:
-        print('Processing .csv.gz to log all device ids:')
-        data_prep = DataPrep()
-        days_num = {'02': 30, '03': 31, '04': 30,
-                    '05': 31, '06': 30, '07': 31,
-                    '08': 31, '09': 30}
-        cols = ['timestamp', 'device_aid', 'latitude', 'longitude', 'location_method']
-        for y in (2022, 2023):  # 2019,
-            for m in ('05', '06', '07', '08', '09'):
-                if ((y == 2022) & (m == '09')) | (y == 2023):
-                    print(f'Processing year {y} - month {m}:')
-                    data_prep.device_logging(year=y, month=m)
 
     if stage == 2:
         print('Processing .csv.gz into parquet by day:')
         # days_num = {'05': 31, '06': 30, '07': 31, '08': 31, '09': 30}
         # days_num = {'02': 30, '03': 31, '04': 30}
         cols = ['timestamp', 'device_aid', 'latitude', 'longitude', 'location_method']
-        data_prep = DataPrep()
-        print('Prepare batches...')
-        data_prep.device_grouping(num_groups=300)
         # To start with (2019, '06', '25')
         trackers = [(x, y) for x in (2022, 2023) for y in ('02', '03', '04')]
         for item in [(2022, '02')]:
             trackers.remove(item)
-        for y, m in trackers:
-            print(f'Processing year {y} - month {m}:')
-            start = time.time()
-            days_list = get_day_list(month=m)
-            # if (m == '08') & (y == 2019):
-            #     del days_list[:17]
-            for day in days_list:
-                data_prep.process_data(selectedcols=cols, year=y, month=m, day=day)
-                data_prep.write_out(year=y, month=m, day=day)
-                # data_prep.dump_to_parquet(year=y, month=m, day=day)
-            end = time.time()
-            time_elapsed = (end - start)//60    #  in minutes
-            print(f"Month {m} processed in {time_elapsed} minutes.")
+        # for y, m in trackers:
+        #     print(f'Processing year {y} - month {m}:')
+        #     for day in get_day_list(month=m):
+        #         data_prep.process_data_stream(selectedcols=cols, year=y, month=m, day=day)
+        days = [(y, m, day) for y, m in trackers for day in get_day_list(month=m)]
+        df_stats = convert_days_parallel(days=days, selectedcols=cols, num_groups=300, legacy=True,
+                                         ram_budget=48 << 30)
+        DataPrep().register_devices(days=days)
 
     if stage == 3:
         cols = ['timestamp', 'device_aid', 'latitude', 'longitude', 'location_method']
         data_prep = DataPrep()
-        data_prep.device_grouping(num_groups=300)
-        for grp in range(139, 149):
-            print(f'Checking batch {grp}....')
-            folder = f'D:/MAD_dbs/raw_data_de/format_parquet/grp_{grp}/'
-            prob_files = []
-            for filename in tqdm(os.listdir(folder), desc='Going through files'):
-                file_path = os.path.join(folder, filename)
-                try:
-                    df = pd.read_parquet(file_path, engine='fastparquet')
-                except:
-                    prob_files.append(file_path)
-
-            print(f'Identified {len(prob_files)} corrupted files to be fixed.')
-            for f in prob_files:
-                rec = prob_files[0].split('/')[-1].split('_')
-                y, m, day = int(rec[0]), rec[1], rec[2]
-                data_prep.reprocess_single_data_file(selectedcols=cols, month=m, year=y, day=day, grp=grp)
+        data_prep.device_grouping(num_groups=300, legacy=True)
+        trackers = [(x, y) for x in (2022, 2023) for y in ('02', '03', '04')]
+        days = [(y, m, day) for y, m in trackers for day in get_day_list(month=m)]
+        df_problems = mad_store.verify_store(root=data_prep.converted_data_folder, level='footer',
+                                             days=days, num_groups=300)
+        print(df_problems.groupby('problem').size())
+        data_prep.reprocess_partitions(problems=df_problems, selectedcols=cols)
 
     if stage == 4:
         cols = ['timestamp', 'device_aid', 'latitude', 'longitude', 'location_method']
         data_prep = DataPrep()
-        data_prep.device_grouping(num_groups=300)
+        data_prep.device_grouping(num_groups=300, legacy=True)
         y, m, day = 2019, '09', '19'
         data_prep.reprocess_single_day(selectedcols=cols, month=m, year=y, day=day)
@@ -9,33 +9,14 @@ ROOT_dir = Path(__file__).parent.parent.parent
 sys.path.append(ROOT_dir)
 sys.path.insert(0, os.path.join(ROOT_dir, 'lib'))
 
+import workers
+
+# Days converted with DataPrep.process_data_stream(drop_low_precision=True) are already filtered
 data_folder = 'D:\\MAD_dbs\\raw_data_de\\format_parquet_b'
 paths = [x[0] for x in os.walk(data_folder)]
 paths = paths[1:]
 
 
-def num_check(x):
-    prec = str(x).split('.')[-1]
-    if len(prec) <= 2:
-        return 1
-    else:
-        p = int(str(x * 100).split('.')[-1])
-        if p == 0:
-            return 1
-        else:
-            return 0
-
-
-def low_precision_check(x, y):
-    try:
-        if (num_check(x) == 1) & (num_check(y) == 1):
-            return 1
-        else:
-            return 0
-    except:
-        return 1
-
-
 class DataFiltering:
     def __init__(self):
         self.paths2raw = {int(x.split('_')[-1]): x for x in paths}
@@ -47,9 +28,7 @@ class DataFiltering:
         file_path = os.path.join(self.paths2raw[batch], file)
         df = pd.read_parquet(file_path)
         L = len(df)
-        df.loc[:, 'low_precision'] = df.apply(lambda row: low_precision_check(row['latitude'], row['longitude']),
-                                              axis=1)
-        df = df.loc[df.low_precision != 1].drop(columns='low_precision')
+        df = df.loc[~workers.low_precision_mask(df['latitude'].values, df['longitude'].values)]
         low_share = 1 - len(df) / L
         target_dir = os.path.join(self.target_folder, 'grp_' + str(batch))
         df.to_parquet(target_dir + f'\\{file}', index=False)
@@ -1,113 +1,83 @@
 from pathlib import Path
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import shutil
 import time
 import os
 os.environ['JAVA_HOME'] = "C:/Java/jdk-1.8"
-from pyspark.sql import SparkSession
 import sys
-import pyspark.sql.functions as F
-from pyspark.sql.types import *
-from pyspark import SparkConf
-from infostop import Infostop
 
 
 ROOT_dir = Path(__file__).parent.parent.parent
 sys.path.append(ROOT_dir)
 sys.path.insert(0, os.path.join(ROOT_dir, 'lib'))
 
-
-# Set up pyspark
-os.environ['PYSPARK_PYTHON'] = sys.executable
-os.environ['PYSPARK_DRIVER_PYTHON'] = sys.executable
-# Create new context
-spark_conf = SparkConf().setMaster("local[18]").setAppName("MobiSeg")
-spark_conf.set("spark.executor.heartbeatInterval","3600s")
-spark_conf.set("spark.network.timeout","7200s")
-spark_conf.set("spark.sql.files.ignoreCorruptFiles","true")
-spark_conf.set("spark.driver.memory", "56g")
-spark_conf.set("spark.driver.maxResultSize", "0")
-spark_conf.set("spark.executor.memory","8g")
-spark_conf.set("spark.memory.fraction", "0.6")
-spark_conf.set("spark.sql.session.timeZone", "UTC")
-spark = SparkSession.builder.config(conf=spark_conf).getOrCreate()
-java_version = spark._jvm.System.getProperty("java.version")
-print(f"Java version used by PySpark: {java_version}")
-print('Web UI:', spark.sparkContext.uiWebUrl)
-
-
-# infostop function
-R1, R2, MIN_STAY, MAX_TIME_BETWEEN = 30, 30, 15, 3  # meters, meters, minutes, hours
+import device_dict
+import mad_store
+import stop_detection
+import stop_engine
+
+# Execution backend: 'pool' (process pool over the parquet store, no JVM) or 'spark'
+backend = 'pool'
+spark = None
+# Newly delivered days (first, last) to add to the existing stops (pool backend), None for a full run
+new_period = None   # e.g., ('2023-02-01', '2023-04-30')
+# Stop detection method: 'infostop' or 'staypoint' (linear time, see src/data_exp/5-stop-method-agreement.py)
+stop_method = 'infostop'
+# Parameter settings to sweep (pool backend), written to dbs/stops_combined/sweep/<setting>/, None for a normal run
+sweep_grid = None   # e.g., stop_detection.param_grid(r1=[20, 30, 50], min_stay=[10, 15, 30])
+
+
+def start_spark():
+    from pyspark.sql import SparkSession
+    from pyspark import SparkConf
+    # Set up pyspark
+    os.environ['PYSPARK_PYTHON'] = sys.executable
+    os.environ['PYSPARK_DRIVER_PYTHON'] = sys.executable
+    # Create new context
+    spark_conf = SparkConf().setMaster("local[18]").setAppName("MobiSeg")
+    spark_conf.set("spark.executor.heartbeatInterval","3600s")
+    spark_conf.set("spark.network.timeout","7200s")
+    spark_conf.set("spark.sql.files.ignoreCorruptFiles","true")
+    spark_conf.set("spark.driver.memory", "56g")
+    spark_conf.set("spark.driver.maxResultSize", "0")
+    spark_conf.set("spark.executor.memory","8g")
+    spark_conf.set("spark.memory.fraction", "0.6")
+    spark_conf.set("spark.sql.session.timeZone", "UTC")
+    spark_session = SparkSession.builder.config(conf=spark_conf).getOrCreate()
+    java_version = spark_session._jvm.System.getProperty("java.version")
+    print(f"Java version used by PySpark: {java_version}")
+    print('Web UI:', spark_session.sparkContext.uiWebUrl)
+    # Ship the stop detection module to the Python workers of infostop_per_user
+    spark_session.sparkContext.addPyFile(os.path.join(ROOT_dir, 'lib', 'stop_detection.py'))
+    return spark_session
+
+
+# infostop function, one row per stay of the device
+def infostop_per_user(key, data):
+    return stop_detection.stop_intervals(stop_detection.detect_stops(key[0], data, method=stop_method))
 
 
-def infostop_per_user(key, data):
-    model = Infostop(
-        r1=R1,
-        r2=R2,
-        label_singleton=True,
-        min_staying_time=MIN_STAY*60,
-        max_time_between=MAX_TIME_BETWEEN*60*60,
-        min_size=2,
-        min_spacial_resolution=0,
-        distance_metric='haversine',
-        weighted=False,
-        weight_exponent=1,
-        verbose=False,)
-    # Remove abnormal and low-precision GPS records
-    x = data.loc[~(((data['latitude'] > 84) | (data['latitude'] < -80)) | ((data['longitude'] > 180) | (data['longitude'] < -180))), :]
-    x = x.sort_values(by='timestamp').drop_duplicates(subset=['latitude', 'longitude', 'timestamp']).\
-        reset_index(drop=True)
-    x = x.dropna()
-
-    x['t_seg'] = x['timestamp'].shift(-1)
-    x.loc[x.index[-1], 't_seg'] = x.loc[x.index[-1],'timestamp']+1
-    x['n'] = x.apply(lambda x: range(int(x['timestamp']),
-                                     min(int(x['t_seg']), x['timestamp']+(MAX_TIME_BETWEEN*60*60)),
-                                     (MAX_TIME_BETWEEN*60*60-1)), axis=1)
-    x = x.explode('n')
-    x['timestamp'] = x['n'].astype(float)
-    x = x[['latitude', 'longitude', 'timestamp']].dropna() # ,'timezone'
-
-    try:
-        labels = model.fit_predict(x[['latitude', 'longitude', 'timestamp']].values)
-    except:
-        return pd.DataFrame([],
-                            columns=['device_aid', 'timestamp', 'latitude', 'longitude',
-                                     'loc', 'stop_latitude', 'stop_longitude', 'interval']) #,'timezone'
-
-    label_medians = model.compute_label_medians()
-    x['loc'] = labels
-    x['same_loc'] = x['loc'] == x['loc'].shift()
-    # x['same_timezone'] = x['timezone']==x['timezone'].shift()
-    x['little_time'] = (x['timestamp'] - x['timestamp'].shift() < MAX_TIME_BETWEEN*60*60)
-
-    x['interval'] = (~(x['same_loc'] & x['little_time'])).cumsum()  # & x['same_timezone']
-
-    latitudes = {k: v[0] for k, v in label_medians.items()}
-    longitudes = {k: v[1] for k, v in label_medians.items()}
-    x['stop_latitude'] = x['loc'].map(latitudes)
-    x['stop_longitude'] = x['loc'].map(longitudes)
-    x['device_aid'] = key[0]
-
-    # keep only stop locations
-    x = x[x['loc'] > 0].copy()
-
-    return x[['device_aid','timestamp','latitude','longitude','loc','stop_latitude','stop_longitude','interval']] #,'timezone'
-
-
-schema = StructType([StructField('loc', IntegerType()),
-                     StructField('timestamp', IntegerType()),
-                     StructField('interval', IntegerType()),
-                     StructField('latitude', DoubleType()),
-                     StructField('longitude', DoubleType()),
-                     StructField('device_aid', StringType()),
-                     StructField('stop_latitude', DoubleType()),
-                     StructField('stop_longitude', DoubleType()),
-                    ]) # StructField('timezone',IntegerType()),
+# Output schema of infostop_per_user; built on demand so the pool backend does not need pyspark
+def stops_schema():
+    from pyspark.sql.types import StructType, StructField, StringType, IntegerType, DoubleType, LongType
+    return StructType([StructField('device_aid', StringType()),
+                       StructField('interval', IntegerType()),
+                       StructField('loc', IntegerType()),
+                       StructField('start', IntegerType()),
+                       StructField('end', IntegerType()),
+                       StructField('latitude', DoubleType()),
+                       StructField('longitude', DoubleType()),
+                       StructField('size', LongType()),
+                      ])
 
 
 class StopDetection:
     def __init__(self):
-        self.file_paths_dict = None
+        self.reader = None
+        self.device_dict = device_dict.DeviceDictionary()
 
     def file_list(self):
         # # File location and structure
@@ -122,37 +92,47 @@ class StopDetection:
         #     self.file_paths_dict[bt] = file_paths   # 300 groups of users
 
         # For combined two time periods
-        self.file_paths_dict = dict()
-        data_folder1 = 'D:\\MAD_dbs\\raw_data_de\\format_parquet_r'
-        paths1 = [data_folder1 + f'\\grp_{x}' for x in range(0, 300)]
-        data_folder2 = 'D:\\MAD_dbs\\raw_data_de\\format_parquet_br'
-        paths2 = [data_folder2 + f'\\grp_{x}' for x in range(0, 300)]
-        self.file_paths_dict = dict()
-        for path1, path2, grp in zip(paths1, paths2, range(0, 300)):
-            files1 = os.listdir(path1)
-            file_paths1 = [os.path.join(path1, f) for f in files1]
-            files2 = os.listdir(path2)
-            file_paths2 = [os.path.join(path2, f) for f in files2]
-            self.file_paths_dict[grp] = file_paths1 + file_paths2   # 300 groups of users
+        data_folders = ['D:\\MAD_dbs\\raw_data_de\\format_parquet_r', 'D:\\MAD_dbs\\raw_data_de\\format_parquet_br']
+        self.reader = mad_store.StoreReader(roots=data_folders)   # 300 groups of users
+
+    def save_stops(self, batch=None, staging=None):
+        """
+        Combine the parquet parts written by Spark into stops_{batch}.parquet, adding the device ids,
+        one part at a time.
+        """
+        file_path = os.path.join(ROOT_dir, f'dbs/stops_combined/stops_{batch}.parquet')
+        tmp_path = mad_store.temp_file(file_path)
+        writer = None
+        for fragment in ds.dataset(staging, format='parquet').get_fragments():
+            df_stops = fragment.to_table().to_pandas()[stop_detection.stop_cols]
+            df_stops['batch'] = batch
+            df_stops['device_id'] = self.device_dict.encode(df_stops['device_aid'], add=True)
+            table = pa.Table.from_pandas(df_stops, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_path, table.schema)
+            writer.write_table(table)
+        if writer is None:
+            df_stops = stop_detection.stop_intervals(pd.DataFrame([], columns=stop_detection.stop_point_cols))
+            df_stops['batch'], df_stops['device_id'] = batch, -1
+            df_stops.to_parquet(tmp_path, index=False)
+        else:
+            writer.close()
+        self.device_dict.save()
+        os.replace(tmp_path, file_path)
+        shutil.rmtree(staging, ignore_errors=True)
 
     def stop_batch(self, batch=None):
         print(f'Processing user group {batch}:')
         start = time.time()
-        file_paths = self.file_paths_dict[batch]
-        df = spark.read.parquet(*file_paths).\
-            select('device_aid', 'timestamp', 'latitude', 'longitude')
-        stops = df.groupby('device_aid').applyInPandas(infostop_per_user, schema=schema)
-        stop_locations = stops.groupby('device_aid', 'interval').agg(F.first('loc').alias('loc'),
-                                                                     F.min('timestamp').alias('start'),
-                                                                     F.max('timestamp').alias('end'),
-                                                                     F.first('stop_latitude').alias('latitude'),
-                                                                     F.first('stop_longitude').alias('longitude'),
-                                                                     F.count('loc').alias('size'))
-        df_stops = stop_locations.toPandas()
-        df_stops['batch'] = batch
+        df = self.reader.spark_dataframe(spark, groups=[batch],
+                                         columns=['device_aid', 'timestamp', 'latitude', 'longitude'])
+        # The stays are aggregated per device in the UDF and written by the executors, nothing is collected
+        stop_locations = df.groupby('device_aid').applyInPandas(infostop_per_user, schema=stops_schema())
+        staging = os.path.join(ROOT_dir, f'dbs/stops_combined/_spark/stops_{batch}')
+        stop_locations.write.mode('overwrite').parquet(staging)
         # Save data to database
         print("Saving data...")
-        df_stops.to_parquet(os.path.join(ROOT_dir, f'dbs/stops_combined/stops_{batch}.parquet'), index=False)
+        self.save_stops(batch=batch, staging=staging)
         end = time.time()
         time_elapsed = (end - start) // 60  # in minutes
         print(f"Group {batch} processed and saved in {time_elapsed} minutes.")
@@ -161,6 +141,17 @@ class StopDetection:
 if __name__ == '__main__':
     sd = StopDetection()
     sd.file_list()
-    # Batch 0-197 are finished / 64
-    for batch in range(0, 300):
-        sd.stop_batch(batch=batch)
+    if backend == 'spark':
+        spark = start_spark()
+        # Batch 0-197 are finished / 64
+        for batch in range(0, 300):
+            sd.stop_batch(batch=batch)
+    else:
+        engine = stop_engine.StopEngine(reader=sd.reader, dictionary=sd.device_dict, workers=18,
+                                        params=dict(method=stop_method))
+        if sweep_grid is not None:
+            engine.sweep(batches=range(0, 300), grid=sweep_grid, method=stop_method)
+        elif new_period is not None:
+            engine.run_incremental(batches=range(0, 300), start=new_period[0], end=new_period[1], window_days=2)
+        else:
+            engine.run(batches=range(0, 300))
@@ -0,0 +1,100 @@
+import sys
+from pathlib import Path
+import os
+import time
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+
+ROOT_dir = Path(__file__).parent.parent.parent
+sys.path.append(ROOT_dir)
+sys.path.insert(0, os.path.join(ROOT_dir, 'lib'))
+
+import mad_store
+import stop_detection
+import stop_engine
+
+# Sample group of the converted data
+data_folders = ['D:\\MAD_dbs\\raw_data_de\\format_parquet_r', 'D:\\MAD_dbs\\raw_data_de\\format_parquet_br']
+sample_group, start, end = 0, '2022-05-01', '2022-05-31'
+num_devices = 2000
+report_file = os.path.join(ROOT_dir, 'dbs/stops_method_agreement.csv')
+
+
+def run_method(data=None, method=None):
+    """
+    :return: stop points, stays and per-device runtime (seconds) and number of points
+    """
+    points, timing = [], []
+    for device_aid, df in tqdm(data.groupby('device_aid', sort=False), desc=method):
+        start_t = time.perf_counter()
+        points.append(stop_detection.detect_stops(device_aid, df, method=method))
+        timing.append(dict(device_aid=device_aid, points=len(df), seconds=time.perf_counter() - start_t))
+    points = pd.concat([p for p in points if len(p) > 0], ignore_index=True)
+    return points, stop_detection.stop_intervals(points), pd.DataFrame(timing)
+
+
+def stay_matches(stays_a=None, stays_b=None, min_iou=0.5):
+    """
+    Best temporal match in stays_b of each stay of stays_a (same device, largest intersection over union).
+    :return: dataframe of the stays of stays_a with iou and the distance (m) to the matched stay
+    """
+    pairs = stays_a.reset_index().merge(stays_b, on='device_aid', suffixes=('', '_b'))
+    inter = np.minimum(pairs['end'], pairs['end_b']) - np.maximum(pairs['start'], pairs['start_b'])
+    pairs = pairs.loc[inter > 0].assign(iou=inter / (np.maximum(pairs['end'], pairs['end_b']) -
+                                                     np.minimum(pairs['start'], pairs['start_b'])))
+    pairs['distance'] = stop_engine.haversine_m(pairs['latitude'], pairs['longitude'],
+                                                pairs['latitude_b'], pairs['longitude_b'])
+    best = pairs.sort_values('iou', ascending=False).drop_duplicates('index').set_index('index')
+    out = stays_a.copy()
+    out['iou'] = best['iou'].reindex(out.index).fillna(0).values
+    out['distance'] = best['distance'].reindex(out.index).values
+    out['matched'] = out['iou'] >= min_iou
+    return out
+
+
+def agreement(res_a=None, res_b=None):
+    points_a, stays_a, timing_a = res_a
+    points_b, stays_b, timing_b = res_b
+    pa_, pb_ = set(zip(points_a['device_aid'], points_a['timestamp'])), set(zip(points_b['device_aid'], points_b['timestamp']))
+    m_ab, m_ba = stay_matches(stays_a, stays_b), stay_matches(stays_b, stays_a)
+    dense = timing_a['points'] >= timing_a['points'].quantile(0.9)
+    locs = pd.concat([stays_a.groupby('device_aid')['loc'].nunique().rename('a'),
+                      stays_b.groupby('device_aid')['loc'].nunique().rename('b')], axis=1).fillna(0)
+    return dict(
+        devices=len(timing_a),
+        points=int(timing_a['points'].sum()),
+        infostop_seconds=timing_a['seconds'].sum(),
+        staypoint_seconds=timing_b['seconds'].sum(),
+        infostop_points_per_s=timing_a['points'].sum() / timing_a['seconds'].sum(),
+        staypoint_points_per_s=timing_b['points'].sum() / timing_b['seconds'].sum(),
+        dense_decile_speedup=timing_a.loc[dense, 'seconds'].sum() / timing_b.loc[dense.values, 'seconds'].sum(),
+        stop_points_jaccard=len(pa_ & pb_) / max(len(pa_ | pb_), 1),
+        stop_points_recall=len(pa_ & pb_) / max(len(pa_), 1),
+        stop_points_precision=len(pa_ & pb_) / max(len(pb_), 1),
+        infostop_stays=len(stays_a),
+        staypoint_stays=len(stays_b),
+        infostop_stays_matched=m_ab['matched'].mean(),
+        staypoint_stays_matched=m_ba['matched'].mean(),
+        matched_distance_median_m=m_ab.loc[m_ab['matched'], 'distance'].median(),
+        stay_hours_ratio=(stays_b['end'] - stays_b['start']).sum() / (stays_a['end'] - stays_a['start']).sum(),
+        locations_per_device_infostop=locs['a'].mean(),
+        locations_per_device_staypoint=locs['b'].mean(),
+        locations_corr=locs['a'].corr(locs['b']))
+
+
+if __name__ == '__main__':
+    reader = mad_store.StoreReader(roots=data_folders)
+    data = reader.read_table(groups=[sample_group], start=start, end=end, columns=stop_engine.point_cols).to_pandas()
+    devices = data['device_aid'].unique()
+    devices = np.random.default_rng(68).choice(devices, size=min(num_devices, len(devices)), replace=False)
+    data = data.loc[data['device_aid'].isin(devices)]
+    print(f'{len(devices)} devices, {len(data)} records of group {sample_group} ({start} - {end}).')
+
+    res_infostop = run_method(data, method='infostop')
+    res_staypoint = run_method(data, method='staypoint')
+    report = pd.Series(agreement(res_infostop, res_staypoint))
+    print(report.to_string(float_format='%.3f'))
+    report.to_frame('value').to_csv(report_file)
+    print(f'Report saved to {report_file}')
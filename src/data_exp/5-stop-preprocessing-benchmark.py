@@ -0,0 +1,76 @@
+import sys
+from pathlib import Path
+import os
+import time
+import numpy as np
+import pandas as pd
+
+
+ROOT_dir = Path(__file__).parent.parent.parent
+sys.path.append(ROOT_dir)
+sys.path.insert(0, os.path.join(ROOT_dir, 'lib'))
+
+import stop_detection
+
+MAX_TIME_BETWEEN = 3  # hours
+
+
+def preprocess_points_legacy(data):
+    # Preprocessing of infostop_per_user before stop_detection.preprocess_points
+    x = data.loc[~(((data['latitude'] > 84) | (data['latitude'] < -80)) | ((data['longitude'] > 180) | (data['longitude'] < -180))), :]
+    x = x.sort_values(by='timestamp').drop_duplicates(subset=['latitude', 'longitude', 'timestamp']).\
+        reset_index(drop=True)
+    x = x.dropna()
+
+    x['t_seg'] = x['timestamp'].shift(-1)
+    x.loc[x.index[-1], 't_seg'] = x.loc[x.index[-1],'timestamp']+1
+    x['n'] = x.apply(lambda x: range(int(x['timestamp']),
+                                     min(int(x['t_seg']), x['timestamp']+(MAX_TIME_BETWEEN*60*60)),
+                                     (MAX_TIME_BETWEEN*60*60-1)), axis=1)
+    x = x.explode('n')
+    x['timestamp'] = x['n'].astype(float)
+    return x[['latitude', 'longitude', 'timestamp']].dropna()
+
+
+def synthetic_trajectory(n=None, seed=None):
+    """
+    GPS points of one device: stays at a few locations with jitter, sampling intervals from seconds to days,
+    repeated pings, duplicated points and a few abnormal coordinates.
+    """
+    rng = np.random.default_rng(seed)
+    intervals = rng.choice([0, 1, 30, 60, 300, 900, 3600, 10799, 10800, 4 * 3600, 86400], size=n,
+                           p=[0.05, 0.05, 0.2, 0.2, 0.2, 0.1, 0.08, 0.02, 0.02, 0.04, 0.04])
+    ts = 1640995200 + np.cumsum(intervals)
+    places = rng.uniform([52.3, 13.2], [52.6, 13.6], size=(8, 2))
+    visit = places[rng.integers(0, len(places), n)]
+    df = pd.DataFrame(dict(device_aid='synthetic', timestamp=ts,
+                           latitude=np.round(visit[:, 0] + rng.normal(0, 1e-4, n), 6),
+                           longitude=np.round(visit[:, 1] + rng.normal(0, 1e-4, n), 6)))
+    df = pd.concat([df, df.sample(frac=0.05, random_state=seed)])
+    df.loc[df.sample(frac=0.001, random_state=seed).index, 'latitude'] = 91.0
+    return df.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+
+def time_per_device(func=None, devices=None, repeat=3):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for df in devices:
+            func(df)
+        best = min(best, time.perf_counter() - start)
+    return best / len(devices) * 1000     # ms
+
+
+if __name__ == '__main__':
+    rows = []
+    for n in (100, 1000, 10000, 100000):
+        devices = [synthetic_trajectory(n=n, seed=s) for s in range(max(1, 2000 // n))]
+        for df in devices:
+            pd.testing.assert_frame_equal(preprocess_points_legacy(df).reset_index(drop=True),
+                                          stop_detection.preprocess_points(df, max_time_between=MAX_TIME_BETWEEN*60*60))
+        legacy = time_per_device(preprocess_points_legacy, devices, repeat=1 if n > 10000 else 3)
+        vectorized = time_per_device(lambda df: stop_detection.preprocess_points(df, max_time_between=MAX_TIME_BETWEEN*60*60),
+                                     devices)
+        rows.append(dict(points=n, legacy_ms=legacy, vectorized_ms=vectorized, speedup=legacy / vectorized))
+        print(rows[-1])
+    print(pd.DataFrame(rows).to_string(index=False, float_format='%.2f'))
@@ -15,6 +15,7 @@ sys.path.append(ROOT_dir)
 sys.path.insert(0, os.path.join(ROOT_dir, 'lib'))
 
 import workers
+import device_dict
 
 data_folder = os.path.join(ROOT_dir, 'dbs/stops_combined_p/')
 paths2stops = {int(x.split('_')[-1].split('.')[0]): \
@@ -69,9 +70,9 @@ if __name__ == '__main__':
     batch = 2
     print(f'Process batch {batch}.')
     start = time.time()
-    df = pd.read_parquet(paths2stops[batch])
+    df = device_dict.DeviceDictionary().read_parquet(paths2stops[batch])
     tqdm.pandas()
-    df_ind = df.groupby('device_aid').progress_apply(ind_count).reset_index()
+    df_ind = df.groupby('device_id').progress_apply(ind_count).reset_index()
     # Stops - duration in min
     var = 'dur'
     one_column_distr(data=df, col=var,